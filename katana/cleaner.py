@@ -1,41 +1,245 @@
 import sqlite3
 
 import os
+import re
 import logging
 import fcntl
 import errno
+import signal
+import threading
 from time import time
+from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
+
+import gevent
 
 from .config import get_config
-from .ipc import IPC
+from .ipc import IPC, Event
+from .meta import Meta
+from .eviction import POLICIES, KINDS
+from .routing import Router, CACHE_PATHS
+from . import metrics
+
+COLUMNS = (('accessed', 'integer'), ('size', 'integer'), ('kind', 'integer DEFAULT 0'),
+           ('hits', 'integer DEFAULT 0'), ('priority', 'real DEFAULT 0'))
+
+UPSERT_ACCESS = (
+    'INSERT INTO cache (path, accessed, size, kind, hits, priority) VALUES (:path, :accessed, :size, :kind, :hits, {insert}) '
+    'ON CONFLICT(path) DO UPDATE SET accessed=max(accessed, excluded.accessed), size=coalesce(excluded.size, size), kind=excluded.kind, '
+    'hits=hits + excluded.hits, priority={update}'
+)
 
 
 class Cleaner(object):
-    def __init__(self):
+    def __init__(self, db_path=None):
         self.config = get_config()
         self.logger = logging.getLogger('katana.cleaner')
 
         self.cleaning = False
+        self.clean_again = False
+        # path => [accessed timestamp, kind, number of accesses] not written yet
+        self.accesses = {}
+        self.flushed = 0
 
-        self.con = sqlite3.connect(self.config['cleaner_db_path'], isolation_level=None)
+        # deletions are done by a pool of threads, the database is only used by the main thread
+        self.deleter = ThreadPoolExecutor(self.config['cleaner_delete_workers'])
+        self.deletions = []
+        self.counters = {'deleted': 0, 'bytes_freed': 0, 'missing': 0, 'locked': 0, 'errors': 0}
+        self.round = None
+
+        self.con = sqlite3.connect(db_path or self.config['cleaner_db_path'], isolation_level=None)
         self.con.execute('pragma journal_mode=OFF')
         self.con.execute('CREATE TABLE IF NOT EXISTS cache (path text PRIMARY KEY NOT NULL, accessed integer)')
+        self.con.execute('CREATE TABLE IF NOT EXISTS state (key text PRIMARY KEY NOT NULL, value)')
+        self.set_policy(self.config['clean_policy'])
+
+        self.ipc = IPC(self.config['ipc_sock_path'], self.config['ipc_hwm'])
+        self.meta = Meta()
+        # the metadata database connection and the metadata cache are shared by the deletion threads
+        self.meta_lock = threading.Lock()
+
+    def _state(self, key, default=None):
+        row = self.con.execute('SELECT value FROM state WHERE key=?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def _set_state(self, key, value):
+        self.con.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (key, value))
+
+    def set_policy(self, name):
+        '''Sets the eviction policy, the priorities of the files are recomputed if the policy changed.
+        '''
+        self.policy = POLICIES[name]()
+        self.upsert_access = UPSERT_ACCESS.format(
+            insert=self.policy.priority_sql(':accessed', ':size', ':hits', ':clock'),
+            update=self.policy.priority_sql('max(accessed, excluded.accessed)', 'coalesce(excluded.size, size)', 'hits + excluded.hits', ':clock'))
+
+        columns = set(row[1] for row in self.con.execute('PRAGMA table_info(cache)'))
+        for column, definition in COLUMNS:
+            if column not in columns:
+                self.con.execute('ALTER TABLE cache ADD COLUMN %s %s' % (column, definition))
+        if self._state('policy') != name:
+            self.logger.info('eviction policy set to %s, computing the priorities', name)
+            self.con.execute('BEGIN')
+            self.con.execute('DROP INDEX IF EXISTS cache_evict')
+            self.con.execute('CREATE INDEX cache_evict ON cache (%s)' % self.policy.order_by)
+            self.con.execute('UPDATE cache SET priority=%s' % self.policy.priority_sql('accessed', 'size', 'hits', '0'))
+            self._set_state('policy', name)
+            self._set_state('clock', 0)
+            self.con.execute('COMMIT')
+
+    def _compile_kinds(self):
+        '''Compiles the cache path templates of the routes to tell the kind of the scanned files.'''
+        patterns = {'source': [], 'resized': []}
+        for route in Router(self.config['routing']).routes:
+            for key, template in route.templates.items():
+                if key not in CACHE_PATHS or not template.tmpl:
+                    continue
+                pattern = template.pattern()
+                if key == 'cache_path_resized':
+                    if route.ctx.get('negotiate'):
+                        # the negotiated format may be appended, see Server._negotiated_path
+                        pattern += r'(?:\.\w+)?'
+                    patterns['resized'].append(pattern)
+                else:
+                    patterns['source'].append(pattern)
+        self.kind_res = dict((kind, re.compile('|'.join('(?:%s)$' % pattern for pattern in kind_patterns)))
+                             for kind, kind_patterns in patterns.items() if kind_patterns)
+
+    def _kind(self, path):
+        '''Returns the kind of a cached file from its path, source unless it only matches a resized template.'''
+        path = path[len(self.cache_dir):]
+        resized = self.kind_res.get('resized')
+        source = self.kind_res.get('source')
+        if resized and resized.match(path) and not (source and source.match(path)):
+            return KINDS['resized']
+        return KINDS['source']
+
+    def _ignored(self, filename):
+        # TODO find a better solution not to index not_found_source and the databases
+        return (filename.endswith('.META') or filename.startswith(('.pregen-', '.revalidate-')) or filename in self.ignored
+                or filename.startswith(self.ignored_prefix))
+
+    def _scan(self, top, since, batches):
+        '''Scans the files under top and puts them in batches as lists of (path, accessed, size, kind).
+
+        With since, only the files of the directories modified since that timestamp are scanned.
+        '''
+        batch_size = self.config['cleaner_init_batch_size']
+        rows = []
+        stack = [top]
+        while stack:
+            dirpath = stack.pop()
+            try:
+                # a file added or removed changes the mtime of its directory but not of its parents
+                scan_files = not since or os.stat(dirpath).st_mtime >= since
+                with os.scandir(dirpath) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif scan_files and entry.is_file(follow_symlinks=False) and not self._ignored(entry.name):
+                            st = entry.stat(follow_symlinks=False)
+                            rows.append((entry.path, int(st.st_atime), st.st_size, self._kind(entry.path)))
+                            if len(rows) >= batch_size:
+                                batches.put(rows)
+                                rows = []
+            except OSError as exc:
+                self.logger.error('error while scanning %s: %s', dirpath, exc)
+        if rows:
+            batches.put(rows)
 
-        self.ipc = IPC(self.config['ipc_sock_path'])
+    def _scan_shard(self, shard, since, batches):
+        # the done marker of a shard is queued after all its files
+        try:
+            self._scan(shard, since, batches)
+        except Exception as exc:
+            batches.put((shard, exc))
+        else:
+            batches.put((shard, None))
+
+    def init(self, incremental=False):
+        '''Scans cache_dir to initialize the content of the cache.
 
-    def init(self):
-        '''Walks in cache_dir to initialize the content of the cache.
+        The top level directories of cache_dir are scanned in parallel by cleaner_init_workers threads
+        and the files are written in transactions of cleaner_init_batch_size files. Every scanned top
+        level directory is checkpointed, an interrupted init resumes where it stopped.
+
+        With incremental, only the directories modified since the start of the last complete scan are
+        scanned again. Deleted files are not removed from the database, the cleaner removes them when
+        it tries to delete them.
         '''
-        # TODO find a better solution not to index not_found_source and cleaner_db
-        cleaner_db = os.path.basename(self.config['cleaner_db_path'])
-        not_found_source = os.path.basename(self.config['not_found_source'])
-        for dirpath, dirnames, filenames in os.walk(self.config['cache_dir']):
-            for filename in filenames:
-                if filename.endswith('.META') or filename in (cleaner_db, not_found_source):
+        self.ignored = set(os.path.basename(self.config[key]) for key in ('cleaner_db_path', 'not_found_source'))
+        self.ignored_prefix = os.path.basename(self.config['meta_db_path'])
+        self.con.execute('CREATE TABLE IF NOT EXISTS init_done (shard text PRIMARY KEY NOT NULL)')
+
+        started = self._state('init_started')
+        if started is None or incremental:
+            started = time()
+            since = self._state('init_completed') if incremental else None
+            self.con.execute('DELETE FROM init_done')
+            self._set_state('init_started', started)
+            self._set_state('init_since', since)
+        else:
+            since = self._state('init_since')
+            self.logger.info('resuming the scan of %s started at %d', self.config['cache_dir'], started)
+        done = set(row[0] for row in self.con.execute('SELECT shard FROM init_done'))
+
+        cache_dir = self.cache_dir = os.path.abspath(self.config['cache_dir'])
+        self._compile_kinds()
+        shards, rows = [], []
+        with os.scandir(cache_dir) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.path not in done:
+                        shards.append(entry.path)
+                elif entry.is_file(follow_symlinks=False) and not self._ignored(entry.name):
+                    st = entry.stat(follow_symlinks=False)
+                    rows.append((entry.path, int(st.st_atime), st.st_size, self._kind(entry.path)))
+        self.logger.info('scanning %d directories of %s, %d already scanned', len(shards), cache_dir, len(done))
+
+        batches = Queue(maxsize=self.config['cleaner_init_workers'] * 4)
+        nb_files = 0
+        scan_start = last_report = time()
+        if rows:
+            self._log_scanned(rows)
+        with ThreadPoolExecutor(self.config['cleaner_init_workers']) as pool:
+            for shard in shards:
+                pool.submit(self._scan_shard, shard, since, batches)
+            remaining = len(shards)
+            while remaining or not batches.empty():
+                batch = batches.get()
+                if isinstance(batch, tuple):
+                    shard, exc = batch
+                    if exc:
+                        self.logger.error('error while scanning %s: %r', shard, exc)
+                    else:
+                        self.con.execute('INSERT OR IGNORE INTO init_done VALUES (?)', (shard,))
+                    remaining -= 1
                     continue
-                path = str('%s/%s' % (os.path.abspath(dirpath), filename), 'utf8')
-                accessed = int(os.path.getatime(path))
-                self.log_access(path, accessed)
+                self._log_scanned(batch)
+                nb_files += len(batch)
+                if time() - last_report >= 10:
+                    last_report = time()
+                    self.logger.info('%d files scanned, %d/%d directories remaining, %d files/s', nb_files, remaining,
+                                     len(shards), nb_files / (last_report - scan_start))
+
+        self._set_state('init_completed', started)
+        self._set_state('init_started', None)
+        duration = max(time() - scan_start, 0.001)
+        self.logger.info('%d files scanned in %.1fs, %d files/s', nb_files, duration, nb_files / duration)
+        return nb_files
+
+    def _log_scanned(self, rows):
+        clock = self._state('clock', 0)
+        try:
+            self.con.execute('BEGIN')
+            self.con.executemany(self.upsert_access, (
+                {'path': path, 'accessed': accessed, 'size': size, 'kind': kind, 'hits': 0, 'clock': clock}
+                for path, accessed, size, kind in rows))
+            self.con.execute('COMMIT')
+        except sqlite3.Error:
+            self.logger.exception('error while logging %d scanned files', len(rows))
+            if self.con.in_transaction:
+                self.con.execute('ROLLBACK')
 
     def count_items(self):
         '''Returns the number of items in the cache.
@@ -44,69 +248,204 @@ class Cleaner(object):
 
     def start(self):
         '''Starts listening on IPC for cache events like CACHE IN/OUT.
+
+        Cache events are coalesced by path, keeping the latest access, and written in
+        batches of cleaner_batch_size paths at least every cleaner_flush_interval seconds.
+        A cleaning is started every clean_every seconds. On SIGTERM or SIGINT, the pending
+        accesses are written before exiting.
         '''
-        if not self.count_items():
-            self.logger.info('Cleaner database %s is empty, initializing it.', self.config['cleaner_db_path'])
+        if not self.count_items() or self._state('init_started') is not None:
+            self.logger.info('Cleaner database %s is empty or not initialized, initializing it.', self.config['cleaner_db_path'])
             self.init()
             self.logger.info('Cleaner database %s initialized with %d items.', self.config['cleaner_db_path'], self.count_items())
 
-        last_run = 0
+        gevent.signal_handler(signal.SIGTERM, self.stop)
+        gevent.signal_handler(signal.SIGINT, self.stop)
+        batch_size = self.config['cleaner_batch_size']
+        flush_interval = self.config['cleaner_flush_interval']
+        next_run = 0
         while True:
             now = time()
-            if last_run + self.config['clean_every'] < now:
-                self.ipc.push('CLEANING START')
-                last_run = now
-
-            msg = self.ipc.pull()
-            self.logger.debug(msg)
-            # TODO: commit every X path
-            if msg == 'CLEANING START':
-                if not self.cleaning:
-                    self.cleaning = True
-                    self.clean()
-                else:
-                    self.logger.warning('already cleaning')
-            elif msg == 'CLEANING STOP':
-                if self.cleaning:
-                    self.cleaning = False
-                else:
-                    self.logger.warning('not cleaning')
-            elif msg.startswith('DELETE'):
-                self.delete_path(msg.split()[1], commit=True)
-            elif msg.startswith('CACHE-'):
-                self.log_access(msg.split()[1], commit=True)
+            if next_run <= now:
+                self.start_cleaning()
+                next_run = now + self.config['clean_every']
 
-    def delete_path(self, path, commit=True):
-        try:
-            lock = open(path, 'w')
-            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
-        except IOError as exc:
-            if exc.errno == errno.EAGAIN:
-                self.logger.debug('%s already locked', path)
-            elif exc.errno == errno.ENOENT:
-                self.logger.warning('%s was not found', path)
-                self.con.execute('DELETE FROM cache where path=?', (path,))
+            if len(self.accesses) >= batch_size or (self.accesses and self.flushed + flush_interval <= now):
+                self.flush_accesses()
+
+            if self.deletions:
+                self.collect_deletions()
+
+            event = self.ipc.pull(timeout=self._timeout(next_run))
+            if event is None:
+                continue
+            self.logger.debug('%s %s %s', event.name, event.kind, event.path)
+            if event.name.startswith('CACHE-'):
+                self._access(event)
             else:
-                self.logger.exception('error while cleaning %s', path)
+                self.logger.warning('unexpected event %s', event.name)
+
+    def _timeout(self, next_run):
+        '''Returns how long to wait for an event: deletions are polled, pending accesses flushed and
+        the next cleaning started in time.'''
+        if self.deletions:
+            return 0.1
+        timeout = max(0, next_run - time())
+        if self.accesses:
+            return min(timeout, max(0, self.flushed + self.config['cleaner_flush_interval'] - time()))
+        return timeout
+
+    def _access(self, event):
+        '''Coalesces a cache event with the pending accesses of its path.'''
+        if not self.accesses:
+            self.flushed = time()
+        access = self.accesses.get(event.path)
+        if access:
+            access[0] = int(time())
+            access[2] += event.count
         else:
+            self.accesses[event.path] = [int(time()), event.kind, event.count]
+
+    def flush_accesses(self):
+        '''Writes the pending accesses in the database.'''
+        if self.accesses:
+            self.log_accesses(self.accesses)
+            self.accesses = {}
+
+    def stop(self):
+        '''Writes the pending accesses and exits.'''
+        self.logger.info('cleaner process stopping, %d pending accesses', len(self.accesses))
+        self.flush_accesses()
+        raise SystemExit(0)
+
+    def start_cleaning(self):
+        '''Starts a cleaning unless one is in progress.'''
+        if self.cleaning:
+            self.logger.debug('already cleaning')
+            return
+        self.cleaning = True
+        self.clean()
+
+    def _delete(self, paths):
+        '''Deletes the files that are not locked by a server, runs in a deletion thread.
+
+        The metadata of a file is deleted while it is locked, before the file: a server can't
+        fetch the file again and write new metadata that would then be deleted.
+
+        Returns:
+            (deleted paths, paths not found, number of paths locked, number of errors, bytes freed)
+        '''
+        deleted, missing, locked, errors, freed = [], [], 0, 0, 0
+        for path in paths:
             try:
-                os.unlink(path + '.META')
+                fd = os.open(path, os.O_RDONLY)
             except OSError as exc:
                 if exc.errno == errno.ENOENT:
-                    self.logger.warning('%s was not found', path + '.META')
+                    missing.append(path)
                 else:
-                    self.logger.exception('error while cleaning %s', path + '.META')
+                    self.logger.error('error while cleaning %s: %s', path, exc)
+                    errors += 1
+                continue
             try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                freed += os.fstat(fd).st_blocks * 512
+                with self.meta_lock:
+                    self.meta.delete(path)
                 os.unlink(path)
+                deleted.append(path)
             except OSError as exc:
-                if exc.errno == errno.ENOENT:
-                    self.logger.warning('%s was not found', path)
+                if exc.errno == errno.EAGAIN:
+                    self.logger.debug('%s already locked', path)
+                    locked += 1
+                elif exc.errno == errno.ENOENT:
+                    missing.append(path)
                 else:
-                    self.logger.exception('error while cleaning %s', path)
-                    return
-            self.con.execute('DELETE FROM cache where path=?', (path,))
-        if commit:
-            self.con.commit()
+                    self.logger.error('error while cleaning %s: %s', path, exc)
+                    errors += 1
+            finally:
+                os.close(fd)
+        return deleted, missing, locked, errors, freed
+
+    def _remove(self, deleted, missing, locked, errors, freed):
+        '''Removes the deleted and missing files from the database in bulk.'''
+        removed = deleted + missing
+        if removed:
+            # the servers delete them from their hot cache
+            self.ipc.publish([Event('DELETE', 'source', path, 1) for path in removed])
+            try:
+                self.con.execute('BEGIN')
+                self.con.executemany('DELETE FROM cache WHERE path=?', ((path,) for path in removed))
+                self.con.execute('COMMIT')
+            except sqlite3.Error:
+                self.logger.exception('error while removing %d files from the database', len(removed))
+                if self.con.in_transaction:
+                    self.con.execute('ROLLBACK')
+        self.counters['deleted'] += len(deleted)
+        self.counters['missing'] += len(missing)
+        self.counters['locked'] += locked
+        self.counters['errors'] += errors
+        self.counters['bytes_freed'] += freed
+        metrics.inc('katana_cleaner_files_total', len(deleted), result='deleted')
+        metrics.inc('katana_cleaner_files_total', len(missing), result='missing')
+        metrics.inc('katana_cleaner_files_total', locked, result='locked')
+        metrics.inc('katana_cleaner_files_total', errors, result='error')
+        metrics.inc('katana_cleaner_freed_bytes_total', freed)
+        if self.round:
+            self.round['deleted'] += len(deleted)
+            self.round['bytes_freed'] += freed
+
+    def delete_path(self, path):
+        '''Deletes a file, its metadata and its entry in the database right away.'''
+        self._remove(*self._delete([path]))
+
+    def delete_paths(self, paths):
+        '''Queues paths for the deletion threads in batches of cleaner_delete_batch_size paths.'''
+        batch_size = self.config['cleaner_delete_batch_size']
+        for i in range(0, len(paths), batch_size):
+            self.deletions.append(self.deleter.submit(self._delete, paths[i:i + batch_size]))
+
+    def collect_deletions(self, wait=False):
+        '''Removes the files deleted by the deletion threads from the database.
+
+        When all the deletions of a cleaning are done, the cleaning starts again if it was not enough.
+        '''
+        pending = []
+        for future in self.deletions:
+            if not wait and not future.done():
+                pending.append(future)
+                continue
+            try:
+                self._remove(*future.result())
+            except Exception:
+                self.logger.exception('error while deleting files')
+                self.counters['errors'] += 1
+        self.deletions = pending
+        if pending or not self.round:
+            return
+
+        duration = max(time() - self.round['start'], 0.001)
+        self.logger.info('cleaner process deleted %d files, %d bytes freed in %.1fs: %d files/s, %d bytes/s',
+                         self.round['deleted'], self.round['bytes_freed'], duration,
+                         self.round['deleted'] / duration, self.round['bytes_freed'] / duration)
+        self.round = None
+        metrics.observe('katana_cleaner_round_seconds', duration)
+        if self.config['metrics_dir']:
+            try:
+                metrics.REGISTRY.dump(self.config['metrics_dir'])
+            except (IOError, OSError) as exc:
+                self.logger.error('cannot dump the metrics in %s: %s', self.config['metrics_dir'], exc)
+        self.cleaning = False
+        if self.clean_again:
+            self.cleaning = True
+            self.clean()
+
+    def stats(self):
+        '''Returns the deletion counters, the number of files not deleted yet and the current deletion rate.'''
+        stats = dict(self.counters)
+        stats['queued'] = sum(1 for future in self.deletions if not future.done())
+        if self.round:
+            stats['files_per_second'] = self.round['deleted'] / max(time() - self.round['start'], 0.001)
+        return stats
 
     def log_access(self, path=None, accessed=None, commit=True):
         '''Log file access in the database.
@@ -116,29 +455,121 @@ class Cleaner(object):
         if path:
             if not accessed:
                 accessed = int(time())
-            if not self.con.execute('UPDATE cache SET accessed=? WHERE path=?', (accessed, path)).rowcount:
-                self.con.execute('INSERT INTO cache VALUES (?, ?)', (path, accessed))
+            self.log_accesses({path: (accessed, 'source', 1)})
         if commit:
             self.con.commit()
 
+    def _access_rows(self, accesses, clock):
+        for path, (accessed, kind, hits) in accesses.items():
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = None
+            yield {'path': path, 'accessed': accessed, 'size': size, 'kind': KINDS.get(kind, 0), 'hits': hits, 'clock': clock}
+
+    def log_accesses(self, accesses):
+        '''Log a batch of file accesses in the database in a single transaction.
+
+        accesses is a dict of path => (accessed timestamp, kind, number of accesses), the size
+        of the files is read when they are logged.
+        '''
+        try:
+            self.con.execute('BEGIN')
+            self.con.executemany(self.upsert_access, self._access_rows(accesses, self._state('clock', 0)))
+            self.con.execute('COMMIT')
+        except sqlite3.Error:
+            self.logger.exception('error while logging %d accesses', len(accesses))
+            if self.con.in_transaction:
+                self.con.execute('ROLLBACK')
+
+    def to_free(self):
+        '''Returns the number of bytes and files to delete to get the usage of cache_dir below cache_dir_max_usage.
+        '''
+        st = os.statvfs(self.config['cache_dir'])
+        max_usage = self.config['cache_dir_max_usage'] / 100.0
+        nb_bytes = ((st.f_blocks - st.f_bfree) - st.f_blocks * max_usage) * st.f_frsize
+        nb_files = (st.f_files - st.f_ffree) - st.f_files * max_usage
+        if self.config['meta_backend'] == 'file':
+            # every file has a .META file
+            nb_files /= 2
+        return max(0, int(nb_bytes)), max(0, int(nb_files))
+
     def clean(self):
-        '''Starts the cleaning process, removing the oldest files until the disk usage is below cache_dir_max_usage.
+        '''Starts the cleaning process, removing the files chosen by the eviction policy until enough
+        bytes and files are freed to get the usage below cache_dir_max_usage.
+
+        At most clean_batch_size files are deleted at once by the deletion threads, the cleaning starts
+        again when they are done if that was not enough.
         '''
         st = os.statvfs(self.config['cache_dir'])
         disk_usage = (st.f_blocks - st.f_bfree) / float(st.f_blocks) * 100
         file_usage = (st.f_files - st.f_ffree) / float(st.f_files) * 100
         self.logger.info('cleaner process starting: Disk space %d%% / Files %d%%', disk_usage, file_usage)
         if max(disk_usage, file_usage) > self.config['cache_dir_max_usage']:
-            nb_clean = self.config['clean_batch_size']
-            query = self.con.execute('SELECT path FROM cache ORDER BY accessed ASC LIMIT ?', (nb_clean,))
-            for result in query:
-                nb_clean -= 1
-                path = str(result[0])
-                self.ipc.push('DELETE %s' % path)
-            self.ipc.push('CLEANING STOP')
-            if not nb_clean:
-                self.ipc.push('CLEANING START')
-            else:
-                self.logger.error('cleaner process ending: no more file to delete')
-        elif self.cleaning:
-            self.ipc.push('CLEANING STOP')
+            nb_bytes, nb_files = self.to_free()
+            self.logger.info('%s eviction: %d bytes and %d files to free', self.policy.name, nb_bytes, nb_files)
+            freed_bytes = freed_files = 0
+            clock = None
+            victims = []
+            query = self.con.execute('SELECT path, size, priority FROM cache ORDER BY %s' % self.policy.order_by)
+            for path, size, priority in query:
+                if (freed_bytes >= nb_bytes and freed_files >= nb_files) or freed_files >= self.config['clean_batch_size']:
+                    break
+                victims.append(path)
+                freed_bytes += size or 0
+                freed_files += 1
+                clock = max(clock, priority) if clock is not None else priority
+            query.close()
+            if clock is not None:
+                self._set_state('clock', clock)
+            self.logger.info('cleaner process deleting %d files, %d bytes', freed_files, freed_bytes)
+            self.clean_again = False
+            if freed_bytes < nb_bytes or freed_files < nb_files:
+                if freed_files >= self.config['clean_batch_size']:
+                    self.clean_again = True
+                else:
+                    self.logger.error('cleaner process ending: no more file to delete')
+            if victims:
+                self.round = {'start': time(), 'deleted': 0, 'bytes_freed': 0}
+                self.delete_paths(victims)
+                return
+        self.cleaning = False
+
+
+if __name__ == '__main__':
+    import sys
+    import random
+    import tempfile
+
+    nb_msgs = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    nb_paths = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    batch_size = 1000
+    paths = ['/data/%d/%d/src.jpeg' % (i % 100, i) for i in range(nb_paths)]
+    msgs = [Event('CACHE-OUT', 'source', random.choice(paths), 1) for _ in range(nb_msgs)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # the access logging of the baseline: a transaction per message, autocommitted
+        con = sqlite3.connect(os.path.join(tmp, 'legacy.db'), isolation_level=None)
+        con.execute('pragma journal_mode=OFF')
+        con.execute('CREATE TABLE IF NOT EXISTS cache (path text PRIMARY KEY NOT NULL, accessed integer)')
+        start = time()
+        for msg in msgs:
+            accessed = int(time())
+            if not con.execute('UPDATE cache SET accessed=? WHERE path=?', (accessed, msg.path)).rowcount:
+                con.execute('INSERT INTO cache VALUES (?, ?)', (msg.path, accessed))
+            con.commit()
+        legacy = nb_msgs / (time() - start)
+        con.close()
+
+        cleaner = Cleaner(os.path.join(tmp, 'batched.db'))
+        start = time()
+        accesses = {}
+        for msg in msgs:
+            accesses[msg.path] = (int(time()), msg.kind, msg.count)
+            if len(accesses) >= batch_size:
+                cleaner.log_accesses(accesses)
+                accesses = {}
+        cleaner.log_accesses(accesses)
+        batched = nb_msgs / (time() - start)
+
+    print('%d messages on %d paths: legacy=%d msg/s batched=%d msg/s' % (nb_msgs, nb_paths, legacy, batched))
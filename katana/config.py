@@ -1,18 +1,61 @@
 DEFAULT_CONFIG = {
     'ipc_sock_path': '/tmp/katana.sock',
+    'ipc_push_window': 1,
+    'ipc_push_batch_size': 1000,
+    'ipc_hwm': 1000,
+    'ipc_drop_policy': 'drop',
+    'ipc_sample_rate': 10,
+    'metrics_path': None,
+    'metrics_dir': None,
+    'metrics_interval': 10,
+    'server_workers': 0,
+    'server_reuseport': False,
+    'server_max_requests': 0,
+    'server_max_rss': 0,
+    'server_graceful_timeout': 30,
+    'server_cleaner': False,
+    'hot_cache_size': 0,
+    'hot_cache_max_object_size': 65536,
+    'hot_cache_min_hits': 2,
     'cleaner_db_path': '/tmp/katana_cleaner.db',
     'clean_batch_size': 100,
     'clean_every': 60,
+    'clean_policy': 'lru',
+    'cleaner_batch_size': 1000,
+    'cleaner_flush_interval': 1,
+    'cleaner_init_workers': 8,
+    'cleaner_delete_workers': 4,
+    'cleaner_delete_batch_size': 500,
+    'cleaner_init_batch_size': 10000,
     'proxy': None,
     'accel_redirect': False,
     'accel_redirect_path': '/resized',
+    'proxy_tee': False,
     'chunk_size': 16 * 1024,
     'thumb_max_width': 1920,
     'thumb_max_height': 1080,
     'thumb_max_quality': 90,
     'thumb_default_quality': 75,
+    'thumb_resample': 'high',
+    'thumb_encoders': {},
+    'thumb_from_variants': False,
+    'thumb_variant_min_ratio': 2,
+    'thumb_variants_index_size': 10000,
+    'resize_workers': 0,
+    'resize_queue_size': 100,
+    'resize_timeout': 10,
+    'decoded_cache_size': 0,
+    'decoded_cache_ttl': 10,
     'origin_fetch_timeout': 3,
     'origin_timeout': 1,
+    'origin_pool_size': 10,
+    'origin_pool_idle_timeout': 30,
+    'origins_resolve_with_get': [],
+    'origin_eject_failures': 3,
+    'origin_eject_time': 30,
+    'negative_cache_size': 10000,
+    'negative_cache_ttl': 60,
+    'negative_cache_db_path': None,
     'routing': [{
         'resize': {
             'url_re': None,
@@ -35,6 +78,12 @@ DEFAULT_CONFIG = {
     },
     'cache_force_expires': False,
     'cache_default_expires': 300,
+    'stale_while_revalidate': 0,
+    'stale_if_error': 0,
+    'meta_backend': 'file',
+    'meta_db_path': '/tmp/katana_meta.db',
+    'meta_cache_size': 10000,
+    'meta_cache_ttl': 10,
     'external_expires': 600,
     'cache_dir': './data',
     'cache_dir_max_usage': 90,
@@ -0,0 +1,51 @@
+__all__ = ['POLICIES', 'KINDS']
+
+# kinds of cached files, stored as integers in the cleaner database
+KINDS = {'source': 0, 'resized': 1}
+
+
+class LRUPolicy(object):
+    """Evicts the least recently accessed files first.
+
+    The priority of a file is computed when it is accessed from its last access time
+    (accessed), size, number of accesses (hits) and the clock of the policy, the file
+    with the lowest priority is evicted first. The clock is the highest priority evicted
+    so far, it ages the files that are not accessed anymore.
+    """
+
+    name = 'lru'
+    priority = '{accessed}'
+    order_by = 'priority'
+
+    def priority_sql(self, accessed, size, hits, clock):
+        return self.priority.format(accessed=accessed, size=size, hits=hits, clock=clock)
+
+
+class GDSFPolicy(LRUPolicy):
+    """Greedy Dual Size Frequency: evicts large and rarely accessed files first, so few
+    large sources are evicted rather than many small thumbnails.
+    """
+
+    name = 'gdsf'
+    priority = '{clock} + {hits} * 1.0 / max(coalesce({size}, 1), 1)'
+
+
+class LFUPolicy(LRUPolicy):
+    """Least Frequently Used with dynamic aging: evicts the less accessed files first, the
+    clock lets newly cached files compete with files that were popular a long time ago.
+    """
+
+    name = 'lfu'
+    priority = '{clock} + {hits}'
+
+
+class VariantsFirstPolicy(LRUPolicy):
+    """Evicts the resized images before the sources they can be produced from again, each
+    kind by least recent access.
+    """
+
+    name = 'variants-first'
+    order_by = 'kind DESC, priority'
+
+
+POLICIES = dict((policy.name, policy) for policy in (LRUPolicy, GDSFPolicy, LFUPolicy, VariantsFirstPolicy))
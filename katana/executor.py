@@ -0,0 +1,130 @@
+import os
+import logging
+import logging.config
+import multiprocessing
+
+from gevent.queue import Queue, Empty
+from gevent.socket import wait_read, timeout as socket_timeout
+
+from . import resizer
+
+__all__ = ['ResizeExecutor', 'ResizeBusy']
+
+
+class ResizeBusy(Exception): pass # flake8: noqa
+
+
+def _worker(conn, logging_config, resizer_config):
+    # the socket was created non blocking by gevent in the server process
+    os.set_blocking(conn.fileno(), True)
+    if logging_config:
+        logging.config.dictConfig(logging_config)
+    logger = logging.getLogger('katana.executor')
+    resizer.configure(**resizer_config)
+    while True:
+        try:
+            name, args = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        try:
+            result = getattr(resizer, name)(*args)
+        except Exception:
+            logger.exception('%s %s failed', name, args[0])
+            result = False if name == 'resize' else [False] * len(args[1])
+        conn.send(result)
+
+
+class ResizeExecutor(object):
+    """Runs resizer.resize and resizer.resize_many in a pool of worker processes.
+
+    The calling greenlet waits cooperatively for the result so the other requests
+    keep being served while images are resized on other cores.
+
+    Args:
+        workers (int): number of worker processes.
+        queue_size (int): maximum number of resizes waiting for a worker, ResizeBusy is
+            raised beyond that.
+        timeout (int): number of seconds to wait for a worker and for a resize, the worker
+            is restarted if the resize takes longer.
+        logging_config (dict): the logging configuration of the workers.
+        resizer_config (dict): the arguments of resizer.configure in the workers.
+    """
+
+    def __init__(self, workers=2, queue_size=100, timeout=10, logging_config=None, resizer_config=None):
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.logging_config = logging_config
+        self.resizer_config = resizer_config or {}
+        self.ctx = multiprocessing.get_context('spawn')
+        self.logger = logging.getLogger('katana.executor')
+        self.waiting = 0
+        self.idle = Queue()
+        for _ in range(workers):
+            self.idle.put(self._start())
+
+    def _start(self):
+        conn, child_conn = self.ctx.Pipe()
+        process = self.ctx.Process(target=_worker, args=(child_conn, self.logging_config, self.resizer_config), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def _stop(self, worker):
+        process, conn = worker
+        conn.close()
+        process.terminate()
+        process.join(1)
+
+    def resize(self, *args):
+        """Same as resizer.resize.
+
+        Raises:
+            ResizeBusy if too many resizes are waiting for a worker.
+        """
+        return self._call('resize', args, False)
+
+    def resize_many(self, *args):
+        """Same as resizer.resize_many.
+
+        Raises:
+            ResizeBusy if too many resizes are waiting for a worker.
+        """
+        return self._call('resize_many', args, [False] * len(args[1]))
+
+    def _call(self, name, args, failed):
+        if self.idle.empty() and self.waiting >= self.queue_size:
+            raise ResizeBusy('%d resizes waiting' % self.waiting)
+        self.waiting += 1
+        try:
+            worker = self.idle.get(timeout=self.timeout)
+        except Empty:
+            raise ResizeBusy('no worker available after %ds' % self.timeout)
+        finally:
+            self.waiting -= 1
+
+        process, conn = worker
+        try:
+            conn.send((name, args))
+            wait_read(conn.fileno(), timeout=self.timeout)
+            return conn.recv()
+        except socket_timeout:
+            self.logger.error('%s %s timed out after %ds, restarting worker', name, args[0], self.timeout)
+            self._stop(worker)
+            worker = self._start()
+            return failed
+        except (EOFError, OSError) as exc:
+            self.logger.error('%s %s failed, restarting worker: %r', name, args[0], exc)
+            self._stop(worker)
+            worker = self._start()
+            return failed
+        except BaseException:
+            # the worker is in an unknown state (killed greenlet, broken pipe)
+            self._stop(worker)
+            worker = self._start()
+            raise
+        finally:
+            self.idle.put(worker)
+
+    def close(self):
+        while not self.idle.empty():
+            self._stop(self.idle.get())
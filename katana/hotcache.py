@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from time import time
+
+__all__ = ['FrequencySketch', 'HotCache']
+
+# halves every counter of a sketch
+HALVE = bytes(count >> 1 for count in range(256))
+
+
+class FrequencySketch(object):
+    """A count-min sketch estimating how often the keys were seen recently (TinyLFU).
+
+    Every key increments depth counters capped at 15, its frequency is the smallest of
+    them. The counters are halved after 10 * width increments so that the keys popular a
+    long time ago are forgotten.
+
+    Args:
+        width (int): number of counters of every row, rounded up to a power of 2.
+        depth (int): number of rows.
+    """
+
+    def __init__(self, width, depth=4):
+        self.width = 1 << max(width - 1, 1).bit_length()
+        self.mask = self.width - 1
+        self.depth = depth
+        self.counters = bytearray(self.width * depth)
+        self.sample_size = 10 * self.width
+        self.additions = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        for row in range(self.depth):
+            h = (h * 0x9E3779B1 + row) & 0xFFFFFFFFFFFF
+            yield row * self.width + ((h >> 16) & self.mask)
+
+    def increment(self, key):
+        counters = self.counters
+        for index in self._indexes(key):
+            if counters[index] < 15:
+                counters[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.counters = bytearray(self.counters.translate(HALVE))
+            self.additions //= 2
+
+    def frequency(self, key):
+        counters = self.counters
+        return min(counters[index] for index in self._indexes(key))
+
+
+class HotCache(object):
+    """An in-memory tier in front of the disk cache, holding the bytes and metadata of small
+    and frequently served files.
+
+    Every access is counted in a FrequencySketch. A file is only admitted once it was served
+    min_hits times, and if it is more frequent than the least recently used files it would
+    evict: files served once, or less often than the files already cached, don't evict them.
+
+    An entry expires with the metadata of its file (timestamp + expires) and is deleted when
+    the file is written again or deleted by the cleaner.
+
+    Args:
+        max_size (int): maximum total size in bytes of the cached files, 0 disables the cache.
+        max_object_size (int): maximum size in bytes of a cached file.
+        min_hits (int): number of times a file must be served to be admitted.
+        max_expires (int): if not None, maximum number of seconds a file is valid, see external_expires.
+    """
+
+    def __init__(self, max_size, max_object_size=65536, min_hits=2, max_expires=None):
+        self.max_size = max_size
+        self.max_object_size = max_object_size
+        self.min_hits = min_hits
+        self.max_expires = max_expires
+        # path => (data, meta, expires)
+        self.items = OrderedDict()
+        self.size = 0
+        # about one counter per object of max_object_size / 8 bytes that can be cached
+        self.sketch = FrequencySketch(max(1024, max_size * 8 // max(max_object_size, 1)))
+        self.counters = {'hits': 0, 'misses': 0, 'admitted': 0, 'rejected': 0}
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, path):
+        """Returns (data, meta) of path or None if it is not cached."""
+        if not self.max_size:
+            return None
+        self.sketch.increment(path)
+        item = self.items.get(path)
+        if item is None:
+            self.counters['misses'] += 1
+            return None
+        data, meta, expires = item
+        if expires < time():
+            self.delete(path)
+            self.counters['misses'] += 1
+            return None
+        self.items.move_to_end(path)
+        self.counters['hits'] += 1
+        return data, meta
+
+    def admissible(self, path, size, meta):
+        """Returns True if path should be read to be added to the cache, see add()."""
+        return (self.max_size and size <= self.max_object_size and size <= self.max_size and 'expires' in meta
+                and path not in self.items and self.sketch.frequency(path) >= self.min_hits)
+
+    def add(self, path, data, meta):
+        """Adds path to the cache if it is more frequent than the files it would evict.
+
+        Returns:
+            True if path was added.
+        """
+        expires = meta['expires'] if self.max_expires is None else min(meta['expires'], self.max_expires)
+        expires += meta['timestamp']
+        if expires < time():
+            return False
+        frequency = self.sketch.frequency(path)
+        victims = []
+        freed = self.max_size - self.size
+        for victim in self.items:
+            if freed >= len(data):
+                break
+            if self.sketch.frequency(victim) >= frequency:
+                self.counters['rejected'] += 1
+                return False
+            victims.append(victim)
+            freed += len(self.items[victim][0])
+        for victim in victims:
+            self.delete(victim)
+        self.items[path] = (data, dict(meta), expires)
+        self.size += len(data)
+        self.counters['admitted'] += 1
+        return True
+
+    def delete(self, path):
+        item = self.items.pop(path, None)
+        if item:
+            self.size -= len(item[0])
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+    def stats(self):
+        return dict(self.counters, size=self.size, items=len(self.items))
+
+
+if __name__ == '__main__':
+    import random
+
+    # hit ratio of the hot cache against a plain LRU of the same size on a zipfian workload
+    # with a scan of one-hit wonders every 1000 requests
+    nb_files = 100000
+    nb_requests = 500000
+    max_size = 2000 * 20000
+    weights = [1.0 / (rank + 1) for rank in range(nb_files)]
+    popular = random.choices(range(nb_files), weights, k=nb_requests)
+    meta = {'timestamp': time(), 'expires': 3600}
+    data = b'x' * 20000
+
+    hot = HotCache(max_size, 65536)
+    lru = OrderedDict()
+    hits = lru_hits = 0
+    wonders = 0
+    start = time()
+    for i, key in enumerate(popular):
+        keys = ['/%d' % key]
+        if i % 1000 == 0:
+            keys.extend('/wonder/%d' % (wonders + j) for j in range(500))
+            wonders += 500
+        for path in keys:
+            if hot.get(path):
+                hits += 1
+            elif hot.admissible(path, len(data), meta):
+                hot.add(path, data, meta)
+            if path in lru:
+                lru.move_to_end(path)
+                lru_hits += 1
+            else:
+                lru[path] = True
+                if len(lru) > max_size // len(data):
+                    lru.popitem(last=False)
+    nb = nb_requests + wonders
+    print('hot cache: %.1f%% hits, %.1f us per request' % (hits * 100.0 / nb, (time() - start) * 1e6 / nb))
+    print('lru: %.1f%% hits' % (lru_hits * 100.0 / nb))
@@ -0,0 +1,152 @@
+__all__ = ['HTTPPool', 'PoolFullError']
+
+from gevent import monkey; monkey.patch_all() # flake8: noqa
+
+import http.client
+import logging
+import select
+from collections import defaultdict, deque
+from time import time
+
+from gevent.lock import BoundedSemaphore
+
+
+class PoolFullError(Exception): pass # flake8: noqa
+
+
+class Response(object):
+    """A response from a pooled connection.
+
+    The response must be closed: the connection goes back to the pool if the
+    body has been fully read, otherwise it is closed.
+    """
+
+    def __init__(self, pool, host, conn, resp):
+        self.pool = pool
+        self.host = host
+        self.conn = conn
+        self.resp = resp
+        self.status = resp.status
+        self.headers = {k.lower(): v for k, v in resp.getheaders()}
+
+    def settimeout(self, timeout):
+        if self.conn and self.conn.sock:
+            self.conn.sock.settimeout(timeout)
+
+    def read(self, amt=None):
+        return self.resp.read(amt)
+
+    def close(self):
+        if self.conn:
+            reusable = self.resp.isclosed() and not self.resp.will_close
+            self.resp.close()
+            self.pool.release(self.host, self.conn, reusable)
+            self.conn = None
+
+
+class HTTPPool(object):
+    """A pool of persistent HTTP connections per host.
+
+    Idle connections are reused most recent first, so a GET following a HEAD
+    on the same host reuses the connection that answered the HEAD.
+
+    Args:
+        max_per_host (int): maximum number of connections in use for a host.
+        idle_timeout (int): number of seconds after which an idle connection is closed.
+        proxy (str): a proxy server with IP/HOST:PORT format (eg: '127.0.0.1:8888').
+    """
+
+    def __init__(self, max_per_host=10, idle_timeout=30, proxy=None):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.proxy = proxy
+        self.idle = defaultdict(deque)
+        self.slots = defaultdict(lambda: BoundedSemaphore(self.max_per_host))
+        self.logger = logging.getLogger('katana.httppool')
+
+    def _is_healthy(self, conn):
+        """An idle connection should not be readable, if it is the server closed it."""
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def _get_conn(self, host, timeout):
+        idle = self.idle[host]
+        now = time()
+        while idle:
+            conn, last_used = idle.pop()
+            if last_used + self.idle_timeout > now and self._is_healthy(conn):
+                conn.sock.settimeout(timeout)
+                return conn, True
+            conn.close()
+        return self._new_conn(host, timeout), False
+
+    def _new_conn(self, host, timeout):
+        return http.client.HTTPConnection(self.proxy or host, timeout=timeout)
+
+    def request(self, method, host, path, headers=None, timeout=5):
+        """Sends a request to host and returns its Response.
+
+        Args:
+            method (str): the HTTP method.
+            host (str): IP/HOST[:PORT] of the server.
+            path (str): the path of the request.
+            headers (dict): the headers of the request.
+            timeout (int): timeout of the connection and of every read.
+
+        Raises:
+            PoolFullError if no connection to host is available after timeout seconds.
+            http.client.HTTPException or OSError if the request failed.
+        """
+        slot = self.slots[host]
+        if not slot.acquire(timeout=timeout):
+            raise PoolFullError('no connection available for %s' % host)
+        url = 'http://%s%s' % (host, path) if self.proxy else path
+        conn = None
+        try:
+            conn, reused = self._get_conn(host, timeout)
+            try:
+                conn.request(method, url, headers=headers or {})
+                resp = conn.getresponse()
+            except (http.client.HTTPException, OSError) as exc:
+                if not reused:
+                    raise
+                # the server may have closed an idle connection, retry with a new one
+                self.logger.debug('reused connection to %s failed: %s', host, exc)
+                conn.close()
+                self._close_idle(host)
+                conn = self._new_conn(host, timeout)
+                conn.request(method, url, headers=headers or {})
+                resp = conn.getresponse()
+            if method == 'HEAD':
+                resp.read()
+            return Response(self, host, conn, resp)
+        except BaseException:
+            if conn:
+                conn.close()
+            slot.release()
+            raise
+
+    def release(self, host, conn, reusable=True):
+        idle = self.idle[host]
+        now = time()
+        while idle and idle[0][1] + self.idle_timeout <= now:
+            idle.popleft()[0].close()
+        if reusable:
+            idle.append((conn, now))
+        else:
+            conn.close()
+        self.slots[host].release()
+
+    def _close_idle(self, host):
+        idle = self.idle[host]
+        while idle:
+            idle.pop()[0].close()
+
+    def close(self):
+        for host in list(self.idle):
+            self._close_idle(host)
@@ -7,16 +7,101 @@ import gevent
 from gevent.queue import Queue
 
 from random import sample
-import urllib.request, urllib.error, urllib.parse
+from time import time
+import http.client
 import logging
 
+from .httppool import HTTPPool, PoolFullError
 
-class DefaultErrorHandler(urllib.request.HTTPDefaultErrorHandler):
 
-    def http_error_default(self, req, fp, code, msg, headers):
-        result = urllib.error.HTTPError(req.get_full_url(), code, msg, headers, fp)
-        result.status = code
-        return result
+class NodeStats(object):
+    """Tracks the health of the nodes to select the ones to query.
+
+    For every node we keep an EWMA of the latency, of the error rate and of the hit rate.
+    Nodes are selected with the power of two choices: among two random nodes we pick
+    the one with the best score. A node failing max_failures times in a row is ejected
+    for eject_time seconds, after which a single query is allowed to probe it again.
+
+    Args:
+        alpha (float): the weight of a new sample in the EWMAs.
+        max_failures (int): number of consecutive failures to eject a node.
+        eject_time (int): number of seconds a node is ejected.
+    """
+
+    def __init__(self, alpha=0.3, max_failures=3, eject_time=30):
+        self.alpha = alpha
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.nodes = {}
+
+    def get(self, ip):
+        node = self.nodes.get(ip)
+        if node is None:
+            node = self.nodes[ip] = {
+                'latency': 0.0,
+                'error_rate': 0.0,
+                'hit_rate': 0.0,
+                'requests': 0,
+                'failures': 0,
+                'ejected_until': 0,
+            }
+        return node
+
+    def score(self, ip):
+        node = self.get(ip)
+        return node['latency'] * (1 + 10 * node['error_rate'])
+
+    def is_available(self, ip, now):
+        return self.get(ip)['ejected_until'] <= now
+
+    def select(self, ips, count):
+        """Returns up to count nodes among ips, avoiding the ejected and the slow ones."""
+        now = time()
+        available = [ip for ip in ips if self.is_available(ip, now)]
+        if not available:
+            # every node is ejected, better to try one than nothing
+            available = sample(ips, 1)
+        selected = []
+        while available and len(selected) < count:
+            if len(available) == 1:
+                choice = available[0]
+            else:
+                choice = min(sample(available, 2), key=self.score)
+            available.remove(choice)
+            selected.append(choice)
+            node = self.get(choice)
+            if node['ejected_until']:
+                # half-open: only one probe until it succeeds or fails
+                node['ejected_until'] = now + self.eject_time
+        return selected
+
+    def _update(self, node, name, value):
+        node[name] = value if not node['requests'] else node[name] + self.alpha * (value - node[name])
+
+    def success(self, ip, latency, hit):
+        node = self.get(ip)
+        self._update(node, 'latency', latency)
+        self._update(node, 'error_rate', 0.0)
+        self._update(node, 'hit_rate', 1.0 if hit else 0.0)
+        node['requests'] += 1
+        node['failures'] = 0
+        node['ejected_until'] = 0
+
+    def failure(self, ip, latency):
+        """Records a failed query, returns True if the node has been ejected."""
+        node = self.get(ip)
+        self._update(node, 'latency', latency)
+        self._update(node, 'error_rate', 1.0)
+        node['requests'] += 1
+        node['failures'] += 1
+        if node['failures'] >= self.max_failures:
+            node['ejected_until'] = time() + self.eject_time
+            return True
+        return False
+
+    def stats(self):
+        now = time()
+        return {ip: dict(node, ejected=node['ejected_until'] > now) for ip, node in self.nodes.items()}
 
 
 class HttpWhoHas(object):
@@ -27,27 +112,36 @@ class HttpWhoHas(object):
 
     The resole process will try to find a node in a cluster storing a specific file and
     will return the full url to the filename.
+
+    With the GET method, the nodes are raced with conditional GET requests instead of
+    HEAD requests: the response of the first node having the file is returned ready to
+    be read and the other requests are cancelled. It saves a round-trip on every miss
+    at the cost of transferring some data that will be thrown away.
     """
 
-    def __init__(self, per_cluster=3, user_agent='HttpWhoHas.py', proxy=None, timeout=5):
+    def __init__(self, per_cluster=3, user_agent='HttpWhoHas.py', proxy=None, timeout=5, pool=None, method='HEAD',
+                 max_failures=3, eject_time=30):
         """Initializes the resolver.
 
         Args:
             per_cluster (int): number of node to query from the same cluster.
             user_agent (str): the user agent that will be used for queries.
-            proxy (str): a proxy server with IP/HOST:PORT format (eg: '127.0.0.1:8888').
+            proxy (str): a proxy server with IP/HOST:PORT format (eg: '127.0.0.1:8888'),
+                only used if no pool is provided.
             timeout (int): timeout of the queries.
+            pool (HTTPPool): the connection pool to use, it can be shared with the code
+                fetching the urls found by the resolver.
+            method (str): HEAD or GET, the method of the queries.
+            max_failures (int): number of consecutive failures to eject a node.
+            eject_time (int): number of seconds an ejected node is not queried.
         """
         self.clusters = {}
         self.per_cluster = per_cluster
         self.user_agent = user_agent
         self.timeout = timeout
-
-        if proxy:
-            urllib.request.install_opener(
-                urllib.request.build_opener(urllib.request.ProxyHandler({'http': proxy})))
-
-        urllib.request.install_opener(urllib.request.build_opener(DefaultErrorHandler()))
+        self.pool = pool if pool else HTTPPool(proxy=proxy)
+        self.method = method
+        self.nodes = NodeStats(max_failures=max_failures, eject_time=eject_time)
 
         self.logger = logging.getLogger('katana.httpwhohas')
 
@@ -68,45 +162,79 @@ class HttpWhoHas(object):
             'per_cluster': min(self.per_cluster, len(ips)),
         }
 
-    def _do_req(self, name, req, res):
-        full_url = req.get_full_url()
+    def stats(self):
+        """Returns the health of every node queried so far, see NodeStats."""
+        return self.nodes.stats()
+
+    def _failure(self, ip, latency):
+        if self.nodes.failure(ip, latency):
+            self.logger.warning('node %s ejected for %ds: %s', ip, self.nodes.eject_time, self.nodes.stats()[ip])
+
+    def _do_req(self, name, ip, filename, headers, res, race, statuses):
+        full_url = 'http://%s%s' % (ip, filename)
+        resp = None
+        start = time()
         try:
-            resp = urllib.request.urlopen(req, timeout=self.timeout)
-            status_code = resp.code
-            if status_code in (200, 304) and not hasattr(req, 'redirect_dict'):
-                host = req.get_header('Host')
+            try:
+                resp = self.pool.request(self.method, ip, filename, headers, timeout=self.timeout)
+            except gevent.GreenletExit:
+                if not race['won']:
+                    # killed at the end of the timeout
+                    self._failure(ip, time() - start)
+                raise
+            except (http.client.HTTPException, OSError, PoolFullError):
+                self._failure(ip, time() - start)
+                raise
+            status_code = resp.status
+            if status_code >= 500:
+                # an answer but not a healthy node, it can be ejected
+                self._failure(ip, time() - start)
+            else:
+                self.nodes.success(ip, time() - start, status_code in (200, 304))
+            if status_code in (200, 304) and not race['won']:
+                race['won'] = True
+                host = headers.get('Host')
                 modified = status_code == 200
                 self.logger.debug(
                     'found url=%s filer=%s host=%s modified=%s', full_url, name, host, modified)
-                res.put({
-                        'filer': name,
-                        'url': full_url,
-                        'host': host,
-                        'modified': modified,
-                        'headers': dict(resp.headers),
-                        })
+                result = {
+                    'filer': name,
+                    'url': full_url,
+                    'ip': ip,
+                    'path': filename,
+                    'host': host,
+                    'modified': modified,
+                    'headers': resp.headers,
+                }
+                if self.method == 'GET':
+                    result['response'], resp = resp, None
+                res.put(result)
             else:
+                statuses.append(status_code)
                 self.logger.debug(
                     '%s url=%s returned code %d', name, full_url, status_code)
-        except (urllib.error.HTTPError, urllib.error.URLError) as exc:
+        except (http.client.HTTPException, OSError, PoolFullError) as exc:
             self.logger.debug('%s url=%s error: %s', name, full_url, exc)
         except Exception as exc:
             self.logger.exception('%s url=%s got an exception', name, full_url)
+        finally:
+            if resp:
+                resp.close()
 
-    def _do_reqs(self, reqs, res):
-        jobs = [gevent.spawn(self._do_req, name, req, res)
-                for name, req in reqs]
+    def _do_reqs(self, jobs, res):
         gevent.joinall(jobs, timeout=self.timeout)
         res.put(None)
         gevent.killall(jobs)
 
-    def resolve(self, filename, etag=None, last_modified=None):
+    def resolve(self, filename, etag=None, last_modified=None, statuses=None):
         """Resolves a filename on the clusters.
 
         Args:
             filename (str): the filename that we are looking for on the clusters.
             etag (str): the etag to user for the query if any.
             last_modified (str): the date in the same format as returned by Last-Modified.
+            statuses (list): if given, the status codes of the nodes that didn't have the file
+                are appended to it, the nodes that failed to answer are not.
 
         Returns:
             A dict if the filename was found otherwise None.
@@ -114,9 +242,13 @@ class HttpWhoHas(object):
             The dict has the following keys:
              * filer (str): the name of the cluster.
              * url (str): the full url of the filename.
+             * ip (str): the node where the filename was found.
+             * path (str): the filename.
              * host (str): the value of the Host header.
              * modified (bool): True if the file has been modified since the previous request.
-             * headers (dict): the HTTP response headers.
+             * headers (dict): the HTTP response headers, with lowercase names.
+             * response (Response): with the GET method, the response to read the file
+               from, it must be closed.
         """
         self.logger.debug('resolving %s', filename)
         res = Queue()
@@ -128,16 +260,21 @@ class HttpWhoHas(object):
                 headers['If-None-Match'] = etag
             elif last_modified:
                 headers['If-Modified-Since'] = last_modified
-            for ip in sample(info['ips'], info['per_cluster']):
+            for ip in self.nodes.select(info['ips'], info['per_cluster']):
                 self.logger.debug(
                     'looking for %s on %s with headers %s', filename, ip, headers)
-                req = urllib.request.Request(
-                    'http://%s%s' % (ip, filename), headers=headers)
-                req.get_method = lambda: 'HEAD'
-                reqs.append((name, req))
+                reqs.append((name, ip, filename, headers))
 
-        gevent.spawn(self._do_reqs, reqs, res)
+        race = {'won': False}
+        if statuses is None:
+            statuses = []
+        jobs = [gevent.spawn(self._do_req, name, ip, filename, headers, res, race, statuses)
+                for name, ip, filename, headers in reqs]
+        gevent.spawn(self._do_reqs, jobs, res)
         result = res.get()
+        if result and self.method == 'GET':
+            # cancel the requests still transferring data
+            gevent.killall(jobs, block=False)
         if result:
             self.logger.debug('found %s on %s: url=%s host=%s', filename,
                               result['filer'], result['url'], result['host'])
@@ -1,43 +1,291 @@
+import random
+import struct
+from collections import deque, namedtuple
+
+import gevent
 from zmq import green as zmq
 
+from .eviction import KINDS
+
 
 class IPCInvalidMode(Exception): pass # flake8: noqa
 class IPCSockPathError(Exception): pass # flake8: noqa
+class IPCProtocolError(Exception): pass # flake8: noqa
+
+
+# an event of the cache: name is one of EVENTS, kind one of KINDS, count the number of
+# times it happened for path since the last push
+Event = namedtuple('Event', 'name kind path count')
+
+# version of the wire format, a message of another version is rejected
+VERSION = 1
+
+EVENTS = ('CACHE-IN', 'CACHE-OUT', 'CLEANING START', 'CLEANING STOP', 'DELETE')
+EVENT_CODES = dict((name, code) for code, name in enumerate(EVENTS))
+KIND_NAMES = dict((code, kind) for kind, code in KINDS.items())
+
+# version, flags, number of strings, number of events
+HEADER = struct.Struct('!BBHH')
+STRING = struct.Struct('!H')
+# event code, kind code, directory string, basename string, count
+EVENT = struct.Struct('!BBHHH')
+MAX_EVENTS = 0x7fff
+MAX_COUNT = 0xffff
+
+DROP_POLICIES = ('drop', 'sample')
+
+
+def encode(events):
+    """Encodes a batch of at most MAX_EVENTS events in a single message.
+
+    Paths are split in a directory and a basename, both interned in a string table so the
+    directory shared by a source and its variants is sent once per message. The table is
+    not kept between messages: a message can be dropped without breaking the next ones.
+    """
+    strings = {}
+    table = []
+    records = []
+    for event in events:
+        split = event.path.rfind('/') + 1
+        directory, basename = event.path[:split], event.path[split:]
+        indexes = []
+        for string in (directory, basename):
+            index = strings.get(string)
+            if index is None:
+                index = strings[string] = len(strings)
+                data = string.encode('utf8')
+                table.append(STRING.pack(len(data)))
+                table.append(data)
+            indexes.append(index)
+        records.append(EVENT.pack(EVENT_CODES[event.name], KINDS[event.kind], indexes[0], indexes[1],
+                                  min(event.count, MAX_COUNT)))
+    return b''.join([HEADER.pack(VERSION, 0, len(strings), len(records))] + table + records)
+
+
+def decode(message):
+    """Returns the list of events of a message, raises IPCProtocolError if it is invalid."""
+    try:
+        version, flags, nb_strings, nb_events = HEADER.unpack_from(message)
+        if version != VERSION:
+            raise IPCProtocolError('unsupported protocol version %d' % version)
+        offset = HEADER.size
+        table = []
+        for _ in range(nb_strings):
+            length, = STRING.unpack_from(message, offset)
+            offset += STRING.size
+            table.append(message[offset:offset + length].decode('utf8'))
+            offset += length
+        records = message[offset:offset + nb_events * EVENT.size]
+        if len(records) != nb_events * EVENT.size:
+            raise IPCProtocolError('truncated message')
+        return [Event(EVENTS[code], KIND_NAMES[kind], table[directory] + table[basename], count)
+                for code, kind, directory, basename, count in EVENT.iter_unpack(records)]
+    except (struct.error, IndexError, KeyError, UnicodeDecodeError) as exc:
+        raise IPCProtocolError('invalid message: %s' % exc)
 
 
 class IPC(object):
+    """Channel of cache events between the servers and the cleaner.
+
+    Events are pushed in batches, see encode(). When hwm is not 0, at most hwm messages are
+    queued on each side of the channel, a batch pushed while the channel is full is dropped.
+    With the 'sample' drop policy, only one CACHE-OUT event out of sample_rate is pushed
+    while the channel is congested: the cleaner then catches up faster and the hits it
+    misses only make the eviction a little less accurate.
 
-    def __init__(self, sock_path):
+    Args:
+        sock_path (str): path of the unix socket.
+        hwm (int): maximum number of queued messages, 0 for no limit.
+        drop_policy (str): 'drop' or 'sample'.
+        sample_rate (int): one CACHE-OUT event out of sample_rate is kept when sampling.
+    """
+
+    def __init__(self, sock_path, hwm=0, drop_policy='drop', sample_rate=10):
+        if drop_policy not in DROP_POLICIES:
+            raise IPCInvalidMode('invalid drop policy %s' % drop_policy)
         self.sock_path = sock_path
+        self.hwm = hwm
+        self.drop_policy = drop_policy
+        self.sample_rate = max(sample_rate, 1)
+        self.congested = False
+        self.counters = {'sent': 0, 'bytes': 0, 'dropped': 0, 'sampled': 0, 'received': 0, 'invalid': 0}
         self.ctx = zmq.Context()
         self.sock_push = None
         self.sock_pull = None
+        self.pulled = deque()
+        self.sock_pub = None
+        self.sock_sub = None
+        self.received = deque()
 
-    def push(self, msg):
+    def _get_sock_push(self):
         if not self.sock_push:
             self.sock_push = self.ctx.socket(zmq.PUSH)
-            self.sock_push.set_hwm(0)
+            self.sock_push.set_hwm(self.hwm)
             self.sock_push.connect("ipc://%s" % self.sock_path)
-        self.sock_push.send_string(msg)
+        return self.sock_push
+
+    def push(self, name, path='', kind='source', count=1):
+        self.push_many([Event(name, kind, path, count)])
 
-    def pull(self):
+    def push_many(self, events):
+        """Pushes a list of events, in as few messages as possible."""
+        if self.congested and self.drop_policy == 'sample':
+            kept = [event for event in events if event.name != 'CACHE-OUT' or random.randrange(self.sample_rate) == 0]
+            self.counters['sampled'] += len(events) - len(kept)
+            events = kept
+        for i in range(0, len(events), MAX_EVENTS):
+            batch = events[i:i + MAX_EVENTS]
+            message = encode(batch)
+            try:
+                self._get_sock_push().send(message, zmq.NOBLOCK if self.hwm else 0)
+            except zmq.Again:
+                self.congested = True
+                self.counters['dropped'] += len(batch)
+                continue
+            self.congested = False
+            self.counters['sent'] += len(batch)
+            self.counters['bytes'] += len(message)
+
+    def pull(self, timeout=None):
+        """Returns the next Event, or None if nothing was received after timeout seconds."""
         if not self.sock_pull:
             self.sock_pull = self.ctx.socket(zmq.PULL)
-            self.sock_pull.set_hwm(0)
+            self.sock_pull.set_hwm(self.hwm)
             self.sock_pull.bind("ipc://%s" % self.sock_path)
-        return self.sock_pull.recv_string()
+        while not self.pulled:
+            if timeout is not None and not self.sock_pull.poll(timeout * 1000):
+                return None
+            try:
+                events = decode(self.sock_pull.recv())
+            except IPCProtocolError:
+                self.counters['invalid'] += 1
+                continue
+            self.counters['received'] += len(events)
+            self.pulled.extend(events)
+        return self.pulled.popleft()
+
+    def publish(self, events):
+        """Publishes events to every subscriber, from the cleaner to the servers."""
+        if not self.sock_pub:
+            self.sock_pub = self.ctx.socket(zmq.PUB)
+            self.sock_pub.set_hwm(self.hwm)
+            self.sock_pub.bind("ipc://%s.pub" % self.sock_path)
+        for i in range(0, len(events), MAX_EVENTS):
+            self.sock_pub.send(encode(events[i:i + MAX_EVENTS]))
+
+    def subscribe(self):
+        """Returns the next published Event."""
+        if not self.sock_sub:
+            self.sock_sub = self.ctx.socket(zmq.SUB)
+            self.sock_sub.set_hwm(self.hwm)
+            self.sock_sub.setsockopt(zmq.SUBSCRIBE, b'')
+            self.sock_sub.connect("ipc://%s.pub" % self.sock_path)
+        while not self.received:
+            try:
+                self.received.extend(decode(self.sock_sub.recv()))
+            except IPCProtocolError:
+                self.counters['invalid'] += 1
+        return self.received.popleft()
+
+    def stats(self):
+        """Returns the counters of events sent, dropped, sampled out and received and of bytes sent."""
+        return dict(self.counters)
+
+
+class EventAggregator(object):
+    """Aggregates cache events before pushing them on IPC.
+
+    The same event for the same path is deduplicated during window seconds, the
+    pending events are then pushed as a single message with the number of
+    times they happened. A window of 0 pushes every event immediately.
+    """
+
+    def __init__(self, ipc, window=1, batch_size=1000):
+        self.ipc = ipc
+        self.window = window
+        self.batch_size = batch_size
+        self.pending = {}
+        self.flusher = None
+
+    def add(self, event, path, kind='source'):
+        if not self.window:
+            self.ipc.push(event, path, kind)
+            return
+        # a CACHE-IN must not be lost for the CACHE-OUT events of the same path
+        key = (event, path)
+        pending = self.pending.get(key)
+        self.pending[key] = (kind, pending[1] + 1 if pending else 1)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+        elif not self.flusher:
+            self.flusher = gevent.spawn_later(self.window, self._flush_later)
+
+    def _flush_later(self):
+        self.flusher = None
+        self.flush()
+
+    def flush(self):
+        if self.flusher:
+            self.flusher.kill(block=False)
+            self.flusher = None
+        pending, self.pending = self.pending, {}
+        self.ipc.push_many([Event(event, kind, path, count) for (event, path), (kind, count) in pending.items()])
 
 if __name__ == '__main__':
     import sys
-    from gevent import sleep
-    sock_path = sys.argv[1]
-    mode = sys.argv[2]
-    if mode == 'push':
-        i = IPC(sock_path)
-        while True:
-            i.push('hello')
-            sleep(0.1)
-    elif mode == 'pull':
-        i = IPC(sock_path)
-        while True:
-            print(i.pull())
+    from time import time
+
+    if len(sys.argv) > 2:
+        sock_path = sys.argv[1]
+        mode = sys.argv[2]
+        if mode == 'push':
+            i = IPC(sock_path)
+            while True:
+                i.push('CACHE-OUT', '/tmp/hello world.jpeg')
+                gevent.sleep(0.1)
+        elif mode == 'pull':
+            i = IPC(sock_path)
+            while True:
+                print(i.pull())
+        sys.exit(0)
+
+    # benchmark of the legacy string protocol against the binary one on cache-like paths
+    import os
+    import tempfile
+
+    nb_events = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    batch_size = 1000
+    paths = []
+    for i in range(nb_events // 4):
+        directory = '/var/cache/katana/%02x/%02x/%032x' % (i % 256, i // 256 % 256, i)
+        paths.append('%s/src.jpeg' % directory)
+        paths.extend('%s/%dx%d.jpeg' % (directory, size, size) for size in (100, 200, 400))
+    events = [Event('CACHE-OUT', 'resized' if i % 4 else 'source', path, 1) for i, path in enumerate(paths)]
+    batches = [events[i:i + batch_size] for i in range(0, len(events), batch_size)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, hwm in (('legacy', 0), ('binary', 0), ('binary, hwm=10', 10)):
+            ipc = IPC(os.path.join(tmp, name.replace(' ', '')), hwm=hwm)
+            ipc.pull(timeout=0)
+            sent = 0
+            start = time()
+            for batch in batches:
+                if name == 'legacy':
+                    frames = [('%s %s %s' % (event.name, event.kind, event.path)).encode('utf8') for event in batch]
+                    ipc._get_sock_push().send_multipart(frames)
+                    sent += sum(len(frame) for frame in frames)
+                else:
+                    ipc.push_many(batch)
+            received = 0
+            while received < len(events) - ipc.counters['dropped']:
+                if name == 'legacy':
+                    frames = ipc.sock_pull.recv_multipart()
+                    received += len([frame.decode('utf8').split(' ', 2) for frame in frames])
+                else:
+                    ipc.pull()
+                    received += 1
+            duration = time() - start
+            stats = ipc.stats()
+            sent = sent or stats['bytes']
+            print('%-15s %d events/s, %.1f bytes/event, %d dropped' % (
+                name, received / duration, sent / float(received or 1), stats['dropped']))
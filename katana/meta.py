@@ -2,36 +2,191 @@ import re
 import os
 import errno
 import logging
+import sqlite3
 from time import time
 from shutil import copy
 from .config import get_config
+from .utils import LRUCache
+from . import metrics
 
-__all__ = ['Meta']
+__all__ = ['Meta', 'FileMetaStore', 'SQLiteMetaStore']
+
+
+class FileMetaStore(object):
+    """Stores the metadata record of every file in a sidecar file with the .META extension."""
+
+    def read(self, cache):
+        """Returns the record of cache or None if there is none."""
+        try:
+            with open('%s.META' % cache, 'r') as cache_meta:
+                return cache_meta.read()
+        except (IOError, OSError) as exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+
+    def write(self, cache, record):
+        with open('%s.META' % cache, 'w') as cache_meta:
+            cache_meta.write(record)
+
+    def delete(self, cache):
+        try:
+            os.remove('%s.META' % cache)
+        except (IOError, OSError) as exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def copy(self, src, dst):
+        copy('%s.META' % src, '%s.META' % dst)
+
+
+class SQLiteMetaStore(object):
+    """Stores the metadata records in a SQLite database shared by the processes.
+
+    There is no inode per record and a record is read with an indexed lookup instead of
+    an open/read/close of a sidecar file.
+
+    Args:
+        db_path (str): path of the database.
+    """
+
+    def __init__(self, db_path):
+        self.con = sqlite3.connect(db_path, isolation_level=None, timeout=5, check_same_thread=False)
+        self.con.execute('pragma journal_mode=WAL')
+        self.con.execute('pragma synchronous=NORMAL')
+        self.con.execute('CREATE TABLE IF NOT EXISTS meta (path text PRIMARY KEY NOT NULL, record text) WITHOUT ROWID')
+
+    def _execute(self, *args):
+        try:
+            return self.con.execute(*args)
+        except sqlite3.Error as exc:
+            raise IOError(str(exc))
+
+    def read(self, cache):
+        row = self._execute('SELECT record FROM meta WHERE path=?', (cache,)).fetchone()
+        return row[0] if row else None
+
+    def write(self, cache, record):
+        self._execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', (cache, record))
+
+    def delete(self, cache):
+        self._execute('DELETE FROM meta WHERE path=?', (cache,))
+
+    def copy(self, src, dst):
+        if not self._execute('INSERT OR REPLACE INTO meta SELECT ?, record FROM meta WHERE path=?', (dst, src)).rowcount:
+            raise IOError(errno.ENOENT, 'no metadata for %s' % src)
+
+    def import_sidecars(self, cache_dir, remove=True, batch_size=1000, check=None):
+        """Imports the .META files found in cache_dir, removing them if remove is True.
+
+        Records are keyed like the server builds the paths, cache_dir + the path of the file
+        relative to cache_dir (see Router), so cache_dir must be the configured value. A
+        sidecar is only removed once check(path), e.g. Meta.get, finds the imported record.
+
+        Returns:
+            The number of imported records.
+        """
+        logger = logging.getLogger('katana.meta')
+        count = 0
+        batch = []
+        sidecars = []
+
+        def flush():
+            self._execute('BEGIN')
+            self.con.executemany('INSERT OR REPLACE INTO meta VALUES (?, ?)', batch)
+            self._execute('COMMIT')
+            if remove:
+                for (cache, record), sidecar in zip(batch, sidecars):
+                    if check(cache) if check else self.read(cache) == record:
+                        os.remove(sidecar)
+                    else:
+                        logger.error('%s not removed, its record cannot be read back', sidecar)
+            del batch[:], sidecars[:]
+
+        for dirpath, dirnames, filenames in os.walk(cache_dir):
+            for filename in filenames:
+                if not filename.endswith('.META'):
+                    continue
+                sidecar = os.path.join(dirpath, filename)
+                cache = '%s/%s' % (cache_dir, os.path.relpath(sidecar, cache_dir)[:-len('.META')])
+                try:
+                    with open(sidecar, 'r') as cache_meta:
+                        batch.append((cache, cache_meta.read()))
+                except (IOError, OSError) as exc:
+                    logger.error('cannot import %s: %s', sidecar, exc)
+                    continue
+                sidecars.append(sidecar)
+                count += 1
+                if len(batch) >= batch_size:
+                    flush()
+                    logger.info('%d metadata records imported', count)
+        if batch:
+            flush()
+        return count
 
 
 class Meta(object):
     """Handles metadata for files in cache.
 
-    Every files in the cache have a file with the same name plus the .META extension.
+    Every files in the cache have a metadata record, stored in a file with the same name plus
+    the .META extension (meta_backend 'file') or in a SQLite database (meta_backend 'sqlite').
 
-    The format of the file is as follow:
-    MAGIC|TIMESTAMP|EXPIRES|LAST_MODIFIED|ETAG
+    The format of the record is as follow:
+    MAGIC|TIMESTAMP|EXPIRES|STALE_WHILE_REVALIDATE|STALE_IF_ERROR|LAST_MODIFIED|ETAG
 
     * MAGIC is a letter that we change when the format of the file is modified (see META_MAGIC).
     * TIMESTAMP is the unix timestamp representing the creation date of the file.
     * EXPIRES is the number of second until the file should be verified on the origin server.
+    * STALE_WHILE_REVALIDATE and STALE_IF_ERROR are the values of the Cache-Control extensions
+      as returned by the origin server, empty if there were none.
     * LAST_MODIFIED is the value of the Last-Modified header as returned by the origin server.
     # ETAG is the value of the Etag header as returned by the origin server.
 
     Example:
-    B|1375472452|10|Wed, 23 May 2012 14:03:44 GMT|"100599a17-17db2-4c0b49a681000"
+    D|1375472452|10|60||Wed, 23 May 2012 14:03:44 GMT|"100599a17-17db2-4c0b49a681000"
+
+    Records of the previous format (C, without the stale windows) are still read.
+
+    Parsed metadata are kept in a bounded LRU (meta_cache_size entries valid for
+    meta_cache_ttl seconds) so hot files don't need to read their record on
+    every request. Other processes may update a record, meta_cache_ttl bounds
+    how long a stale entry can be served.
     """
 
-    META_MAGIC = 'C'
+    META_MAGIC = 'D'
 
     def __init__(self):
         self.config = get_config()
         self.logger = logging.getLogger('katana.meta')
+        self.cache = LRUCache(self.config['meta_cache_size'], self.config['meta_cache_ttl'])
+        if self.config['meta_backend'] == 'sqlite':
+            self.store = SQLiteMetaStore(self.config['meta_db_path'])
+        else:
+            self.store = FileMetaStore()
+
+    def invalidate(self, cache):
+        """Removes the metadata of a file from the in-process cache.
+
+        Args:
+            cache (str): path to the file in the cache.
+        """
+        self.cache.delete(cache)
+
+    def delete(self, cache):
+        """Deletes the metadata of a file in the cache.
+
+        Args:
+            cache (str): path to the file in the cache.
+        """
+        self.cache.delete(cache)
+        try:
+            self.store.delete(cache)
+        except (IOError, OSError) as exc:
+            self.logger.error('Meta.delete failed for %s: %s', cache, exc)
+
+    def stats(self):
+        """Returns the size, hits and misses counters of the in-process cache."""
+        return self.cache.stats()
 
     def get(self, cache):
         """Returns the metadata of a file in the cache.
@@ -43,6 +198,8 @@ class Meta(object):
             A dict with the metadata:
              * timestamp (int)
              * expires (int)
+             * stale_while_revalidate (int): seconds the file can be served while revalidated once expired
+             * stale_if_error (int): seconds the file can be served once expired if the origin fails
              * last_modified (str)
              * etag (str)
 
@@ -50,31 +207,48 @@ class Meta(object):
              {
                'timestamp': 1375472436,
                'expires': 10,
+               'stale_while_revalidate': 60,
+               'stale_if_error': 0,
                'last_modified': 'Wed, 23 May 2012 14:03:44 GMT',
                'etag': '"100599a17-17db2-4c0b49a681000"'
              }
 
            If the file is not found or an error occured accessing it, an empty dict is returned.
         """
+        meta = self.cache.get(cache)
+        if meta is not None:
+            return dict(meta)
 
         try:
-            with open('%s.META' % cache, 'r') as cache_meta:
-                splitted = cache_meta.read().split('|')
-                if splitted[0] == self.META_MAGIC:
-                    magic, timestamp, expires, last_modified, etag = splitted
+            start = time()
+            record = self.store.read(cache)
+            metrics.observe('katana_meta_io_seconds', time() - start, op='read')
+            if record is not None:
+                splitted = record.split('|')
+                if splitted[0] in (self.META_MAGIC, 'C'):
+                    if splitted[0] == 'C':
+                        magic, timestamp, expires, last_modified, etag = splitted
+                        stale_while_revalidate = stale_if_error = ''
+                    else:
+                        magic, timestamp, expires, stale_while_revalidate, stale_if_error, last_modified, etag = splitted
                     expires = self.config['cache_default_expires'] if self.config['cache_force_expires'] else int(expires)
-                    return {
+                    meta = {
                         'timestamp': int(timestamp),
                         'expires': expires,
+                        'stale_while_revalidate': int(stale_while_revalidate or self.config['stale_while_revalidate']),
+                        'stale_if_error': int(stale_if_error or self.config['stale_if_error']),
                         'last_modified': last_modified,
                         'etag': etag,
                     }
+                    self.cache.set(cache, meta)
+                    return dict(meta)
                 else:
                     self.logger.error('Meta.get wrong magic [%s] for %s', splitted[0], cache)
-                    os.remove('%s.META' % cache)
+                    self.store.delete(cache)
         except (IOError, OSError) as exc:
             if exc.errno != errno.ENOENT:
                 self.logger.error('Meta.get failed for %s: %s', cache, exc)
+                metrics.inc('katana_meta_errors_total', op='read')
         return {}
 
     def set(self, cache, headers):
@@ -91,28 +265,44 @@ class Meta(object):
         """
 
         try:
-            with open('%s.META' % cache, 'w') as cache_meta:
-                timestamp = int(time())
-                etag = headers.get('etag', '')
-                last_modified = headers.get('last-modified', '')
-                expires = self.config['cache_default_expires']
-                cache_control = headers.get('cache-control', '')
-                m = re.match('.*max-age=(\d+).*', cache_control if cache_control else '')
-                if m:
-                    expires = int(m.group(1))
-                cache_meta.write('%s|%s|%s|%s|%s' % (self.META_MAGIC, timestamp, expires, last_modified, etag))
-                return {
-                    'timestamp': timestamp,
-                    'expires': expires,
-                    'last_modified': last_modified,
-                    'etag': etag,
-                }
+            timestamp = int(time())
+            etag = headers.get('etag', '')
+            last_modified = headers.get('last-modified', '')
+            expires = self.config['cache_default_expires']
+            cache_control = headers.get('cache-control', '')
+            m = re.match(r'.*max-age=(\d+).*', cache_control if cache_control else '')
+            if m:
+                expires = int(m.group(1))
+            stale = {}
+            for extension in ('stale-while-revalidate', 'stale-if-error'):
+                m = re.search(r'%s=(\d+)' % extension, cache_control if cache_control else '')
+                stale[extension] = m.group(1) if m else ''
+            start = time()
+            record = '%s|%s|%s|%s|%s|%s|%s' % (self.META_MAGIC, timestamp, expires, stale['stale-while-revalidate'],
+                                               stale['stale-if-error'], last_modified, etag)
+            self.store.write(cache, record)
+            metrics.observe('katana_meta_io_seconds', time() - start, op='write')
+            meta = {
+                'timestamp': timestamp,
+                'expires': expires,
+                'stale_while_revalidate': int(stale['stale-while-revalidate'] or self.config['stale_while_revalidate']),
+                'stale_if_error': int(stale['stale-if-error'] or self.config['stale_if_error']),
+                'last_modified': last_modified,
+                'etag': etag,
+            }
+            self.cache.set(cache, meta)
+            return dict(meta)
         except (IOError, OSError) as exc:
+            self.cache.delete(cache)
             self.logger.error('Meta.set failed for %s: %s', cache, exc)
+            metrics.inc('katana_meta_errors_total', op='write')
         return {}
 
     def copy(self, src, dst):
+        self.cache.delete(dst)
         try:
-            copy('%s.META' % src, '%s.META' % dst)
+            start = time()
+            self.store.copy(src, dst)
+            metrics.observe('katana_meta_io_seconds', time() - start, op='copy')
         except (IOError, OSError) as exc:
             self.logger.error('Meta.copy from %s to %s failed: %s', src, dst, exc)
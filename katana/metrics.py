@@ -0,0 +1,161 @@
+import os
+import json
+import logging
+import tempfile
+from bisect import bisect_left
+from time import time
+
+__all__ = ['Registry', 'REGISTRY', 'inc', 'observe', 'gauge']
+
+# upper bounds in seconds of the latency histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels, extra=()):
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, _escape(value)) for name, value in labels)
+
+
+def _key(name, labels):
+    return name, tuple((label, str(value)) for label, value in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Registry(object):
+    """Counters, gauges and latency histograms of a process.
+
+    A metric is identified by its name and labels, it is created the first time it is
+    updated. Updating a metric is a dict lookup and an addition, so they can be used on
+    the hot paths of the server.
+
+    Processes sharing a directory dump their metrics in it (see dump()), any of them can
+    then render the metrics of all the processes, counters and histograms being summed.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.gauges = {}
+        # (name, labels) => [count of every bucket and +Inf, sum]
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + value
+
+    def gauge(self, name, value, **labels):
+        self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        histogram[bisect_left(self.buckets, seconds)] += 1
+        histogram[-1] += seconds
+
+    def snapshot(self):
+        """Returns the metrics as a JSON serializable dict."""
+        return {
+            'buckets': list(self.buckets),
+            'counters': [[name, labels, value] for (name, labels), value in self.counters.items()],
+            'gauges': [[name, labels, value] for (name, labels), value in self.gauges.items()],
+            'histograms': [[name, labels, values] for (name, labels), values in self.histograms.items()],
+        }
+
+    def dump(self, directory):
+        """Writes the snapshot of the metrics of this process in directory."""
+        fd, tmp = tempfile.mkstemp(dir=directory, prefix='.')
+        with os.fdopen(fd, 'w') as snapshot:
+            json.dump(self.snapshot(), snapshot)
+        os.rename(tmp, os.path.join(directory, '%d.json' % os.getpid()))
+
+    def collect(self, directory=None):
+        """Returns the snapshots of this process and of the processes that dumped theirs in directory."""
+        snapshots = {os.getpid(): self.snapshot()}
+        if directory:
+            for filename in os.listdir(directory):
+                pid, _, ext = filename.partition('.')
+                if ext != 'json' or not pid.isdigit() or int(pid) in snapshots:
+                    continue
+                try:
+                    with open(os.path.join(directory, filename)) as snapshot:
+                        snapshots[int(pid)] = json.load(snapshot)
+                except (IOError, OSError, ValueError) as exc:
+                    logging.getLogger('katana.metrics').warning('cannot read the metrics in %s: %s', filename, exc)
+        return snapshots
+
+    def render(self, directory=None):
+        """Returns the metrics in the Prometheus text format, summed over the processes of directory.
+
+        Gauges are not summed, they get a pid label.
+        """
+        counters = {}
+        gauges = {}
+        histograms = {}
+        for pid, snapshot in sorted(self.collect(directory).items()):
+            if tuple(snapshot['buckets']) != tuple(self.buckets):
+                continue
+            for name, labels, value in snapshot['counters']:
+                key = _key(name, labels)
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, value in snapshot['gauges']:
+                name, labels = _key(name, labels)
+                gauges[(name, labels + (('pid', str(pid)),))] = value
+            for name, labels, values in snapshot['histograms']:
+                key = _key(name, labels)
+                if key in histograms:
+                    histograms[key] = [total + value for total, value in zip(histograms[key], values)]
+                else:
+                    histograms[key] = list(values)
+
+        lines = []
+        for kind, metrics in (('counter', counters), ('gauge', gauges)):
+            typed = set()
+            for (name, labels), value in sorted(metrics.items()):
+                if name not in typed:
+                    lines.append('# TYPE %s %s' % (name, kind))
+                    typed.add(name)
+                lines.append('%s%s %s' % (name, _labels(labels), _number(value)))
+        typed = set()
+        for (name, labels), values in sorted(histograms.items()):
+            if name not in typed:
+                lines.append('# TYPE %s histogram' % name)
+                typed.add(name)
+            count = 0
+            for bound, value in zip(self.buckets + ('+Inf',), values):
+                count += value
+                lines.append('%s_bucket%s %d' % (name, _labels(labels, [('le', bound)]), count))
+            lines.append('%s_sum%s %s' % (name, _labels(labels), _number(values[-1])))
+            lines.append('%s_count%s %d' % (name, _labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+# the registry of the process
+REGISTRY = Registry()
+inc = REGISTRY.inc
+gauge = REGISTRY.gauge
+observe = REGISTRY.observe
+
+
+if __name__ == '__main__':
+    import timeit
+
+    registry = Registry()
+    nb = 1000000
+    for name, stmt in (('inc', lambda: registry.inc('katana_requests_total', route='0', status='200')),
+                       ('observe', lambda: registry.observe('katana_request_seconds', 0.003, route='0'))):
+        duration = timeit.timeit(stmt, number=nb)
+        print('%s: %.2f us' % (name, duration / nb * 1e6))
+    start = time()
+    registry.render()
+    print('render: %.2f ms' % ((time() - start) * 1000))
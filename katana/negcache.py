@@ -0,0 +1,75 @@
+import sqlite3
+import logging
+from time import time
+
+from .utils import LRUCache
+
+__all__ = ['NegativeCache']
+
+
+class NegativeCache(object):
+    """Remembers the files that were not found on an origin.
+
+    Entries are kept in a bounded in-process LRU for ttl seconds. If db_path is set,
+    they are also stored in a small SQLite table so the other workers can skip the
+    origin too.
+
+    Args:
+        max_size (int): maximum number of entries in memory, 0 disables the cache.
+        ttl (int): number of seconds a file is considered as not found.
+        db_path (str): path of the SQLite database shared between the workers.
+    """
+
+    PURGE_EVERY = 1000
+
+    def __init__(self, max_size=10000, ttl=60, db_path=None):
+        self.ttl = ttl
+        self.enabled = bool(max_size and ttl)
+        self.cache = LRUCache(max_size, ttl)
+        self.logger = logging.getLogger('katana.negcache')
+        self.con = None
+        self.nb_set = 0
+        if self.enabled and db_path:
+            self.con = sqlite3.connect(db_path, isolation_level=None, timeout=1)
+            self.con.execute('pragma journal_mode=WAL')
+            self.con.execute('pragma synchronous=OFF')
+            self.con.execute('CREATE TABLE IF NOT EXISTS not_found (key text PRIMARY KEY NOT NULL, expires integer)')
+
+    def get(self, origin_name, origin_path):
+        """Returns True if origin_path was recently not found on origin_name."""
+        if not self.enabled:
+            return False
+        key = '%s:%s' % (origin_name, origin_path)
+        if self.cache.get(key):
+            return True
+        if self.con:
+            try:
+                row = self.con.execute('SELECT expires FROM not_found WHERE key=?', (key,)).fetchone()
+            except sqlite3.Error as exc:
+                self.logger.error('NegativeCache.get failed for %s: %s', key, exc)
+            else:
+                now = time()
+                if row and row[0] > now:
+                    # expires when the shared entry does
+                    self.cache.set(key, True, row[0] - now)
+                    return True
+        return False
+
+    def set(self, origin_name, origin_path):
+        """Records that origin_path was not found on origin_name."""
+        if not self.enabled:
+            return
+        key = '%s:%s' % (origin_name, origin_path)
+        self.cache.set(key, True)
+        if self.con:
+            now = time()
+            try:
+                self.con.execute('INSERT OR REPLACE INTO not_found VALUES (?, ?)', (key, int(now + self.ttl)))
+                self.nb_set += 1
+                if not self.nb_set % self.PURGE_EVERY:
+                    self.con.execute('DELETE FROM not_found WHERE expires < ?', (now,))
+            except sqlite3.Error as exc:
+                self.logger.error('NegativeCache.set failed for %s: %s', key, exc)
+
+    def stats(self):
+        return self.cache.stats()
@@ -0,0 +1,326 @@
+import os
+import sys
+import errno
+import socket
+import signal
+import logging
+from time import time
+
+from .config import get_config
+
+__all__ = ['Supervisor']
+
+SIGNALS = (signal.SIGCHLD, signal.SIGTERM, signal.SIGINT, signal.SIGQUIT, signal.SIGHUP, signal.SIGUSR1)
+
+
+def rss():
+    """Returns the resident set size of the process in bytes."""
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def listen(address, reuseport=False, backlog=1024):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    # inherited by the accepted connections: the body sent after the headers is not delayed
+    # until the client acknowledges them
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+class Worker(object):
+    """A server process of the Supervisor, serving the requests accepted on its listener.
+
+    The worker retires after server_max_requests requests or when its RSS is above
+    server_max_rss MB: it asks the supervisor for a replacement (SIGUSR1), then stops
+    accepting connections and exits once its requests are done.
+    """
+
+    def __init__(self, listener, address, reuseport):
+        self.config = get_config()
+        self.logger = logging.getLogger('katana.prefork')
+        self.listener = listener
+        self.address = address
+        self.reuseport = reuseport
+        self.requests = 0
+        self.server = None
+        self.retiring = False
+
+    def app(self, environ, start_response):
+        self.requests += 1
+        if self.config['server_max_requests'] and self.requests == self.config['server_max_requests']:
+            self.retire('%d requests served' % self.requests)
+        return self.katana.app(environ, start_response)
+
+    def retire(self, reason):
+        if self.retiring:
+            return
+        self.retiring = True
+        self.logger.info('worker %d retiring: %s', os.getpid(), reason)
+        os.kill(os.getppid(), signal.SIGUSR1)
+        self.gevent.spawn(self.stop)
+
+    def stop(self):
+        self.retiring = True
+        self.server.stop(timeout=self.config['server_graceful_timeout'])
+
+    def _check_rss(self):
+        while not self.retiring:
+            self.gevent.sleep(5)
+            size = rss()
+            if size > self.config['server_max_rss'] * 1024 * 1024:
+                self.retire('RSS of %d MB' % (size / 1024 / 1024))
+
+    def run(self):
+        # imported in the worker only: the server monkey patches the process
+        from katana.server import Server
+        from katana.wsgi import SendfileHandler
+        import gevent
+        from gevent.pywsgi import WSGIServer
+
+        self.gevent = gevent
+        self.katana = Server()
+        if self.reuseport:
+            listener = listen(self.address, True)
+        else:
+            listener = socket.socket(fileno=self.listener.detach())
+        self.server = WSGIServer(listener, self.app, handler_class=SendfileHandler)
+        gevent.signal_handler(signal.SIGTERM, gevent.spawn, self.stop)
+        gevent.signal_handler(signal.SIGINT, gevent.spawn, self.stop)
+        if self.config['server_max_rss']:
+            gevent.spawn(self._check_rss)
+        self.server.serve_forever()
+        self.katana.events.flush()
+
+
+class Supervisor(object):
+    """Pre-forks server_workers server processes serving the same address and supervises them.
+
+    The workers share the listening socket of the supervisor, or each has its own with
+    server_reuseport so the kernel spreads the connections between them. A worker that
+    exits is replaced, and with server_cleaner the supervisor also runs the cleaner.
+
+    Signals:
+        SIGHUP: reloads the configuration, starts new workers and a new cleaner then stops
+            the old ones gracefully.
+        SIGTERM, SIGINT: stops the workers gracefully, then the supervisor.
+        SIGQUIT: stops the workers immediately.
+
+    Args:
+        address (tuple): the (ip, port) to listen on.
+    """
+
+    def __init__(self, address):
+        self.config = get_config()
+        self.logger = logging.getLogger('katana.prefork')
+        self.address = address
+        self.listener = None
+        # pid => start time of the current workers
+        self.workers = {}
+        self.cleaner = None
+        # the cleaner being stopped, a new one can only bind the IPC socket once it exited
+        self.old_cleaner = None
+        # pid => deadline of the workers and cleaners being stopped
+        self.stopping = {}
+        self.respawn_after = 0
+
+    def _fork(self, target):
+        pid = os.fork()
+        if pid:
+            return pid
+        status = 0
+        try:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, SIGNALS)
+            for signum in SIGNALS:
+                signal.signal(signum, signal.SIG_DFL)
+            target()
+        except (SystemExit, KeyboardInterrupt):
+            pass
+        except BaseException:
+            self.logger.exception('process %d failed', os.getpid())
+            status = 1
+        finally:
+            os._exit(status)
+
+    def _run_worker(self):
+        Worker(self.listener, self.address, self.config['server_reuseport']).run()
+
+    def _run_cleaner(self):
+        from katana.cleaner import Cleaner
+        Cleaner().start()
+
+    def spawn_worker(self):
+        pid = self._fork(self._run_worker)
+        self.workers[pid] = time()
+        self.logger.info('worker %d started', pid)
+
+    def spawn_cleaner(self):
+        self.cleaner = self._fork(self._run_cleaner)
+        self.logger.info('cleaner %d started', self.cleaner)
+
+    def stop(self, pid, graceful=True):
+        """Stops a worker or the cleaner, it is killed if still alive after server_graceful_timeout."""
+        self.workers.pop(pid, None)
+        if pid == self.cleaner:
+            self.cleaner = None
+            self.old_cleaner = pid
+        self.stopping[pid] = time() + (self.config['server_graceful_timeout'] if graceful else 0)
+        self._kill(pid, signal.SIGTERM if graceful else signal.SIGKILL)
+
+    def _kill(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+
+    def reload(self):
+        self.logger.info('reloading')
+        self.config = get_config()
+        old = list(self.workers)
+        cleaner = self.cleaner
+        for _ in range(self.config['server_workers']):
+            self.spawn_worker()
+        for pid in old:
+            self.stop(pid)
+        if cleaner:
+            # a single cleaner can listen on the IPC socket
+            self.stop(cleaner)
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as exc:
+                if exc.errno == errno.ECHILD:
+                    return
+                raise
+            if not pid:
+                return
+            if pid == self.old_cleaner:
+                self.old_cleaner = None
+            if pid in self.stopping:
+                del self.stopping[pid]
+                continue
+            if pid == self.cleaner:
+                self.logger.error('cleaner %d exited with status %d', pid, status)
+                self.cleaner = None
+            elif pid in self.workers:
+                started = self.workers.pop(pid)
+                self.logger.error('worker %d exited with status %d', pid, status)
+                if time() - started < 1:
+                    # don't fork in a loop if the workers can't start
+                    self.respawn_after = time() + 1
+
+    def _maintain(self, running):
+        now = time()
+        for pid, deadline in list(self.stopping.items()):
+            if deadline < now:
+                self.logger.warning('process %d still running, killing it', pid)
+                self._kill(pid, signal.SIGKILL)
+                self.stopping[pid] = now + 3600
+        if not running or now < self.respawn_after:
+            return
+        while len(self.workers) < self.config['server_workers']:
+            self.spawn_worker()
+        if self.config['server_cleaner'] and not self.cleaner and not self.old_cleaner:
+            self.spawn_cleaner()
+
+    def run(self):
+        if self.config['metrics_dir']:
+            # the snapshots of the processes of a previous run
+            for filename in os.listdir(self.config['metrics_dir']):
+                if filename.endswith('.json'):
+                    os.remove(os.path.join(self.config['metrics_dir'], filename))
+        if not self.config['server_reuseport']:
+            self.listener = listen(self.address)
+        signal.pthread_sigmask(signal.SIG_BLOCK, SIGNALS)
+
+        running = True
+        while running or self.workers or self.stopping or self.cleaner:
+            self._reap()
+            self._maintain(running)
+            info = signal.sigtimedwait(SIGNALS, 1)
+            if info is None or info.si_signo == signal.SIGCHLD:
+                continue
+            if info.si_signo == signal.SIGUSR1 and info.si_pid in self.workers:
+                # a worker retires, it is replaced before it stops accepting connections
+                self.workers.pop(info.si_pid)
+                self.stopping[info.si_pid] = time() + self.config['server_graceful_timeout']
+            elif info.si_signo == signal.SIGHUP and running:
+                self.reload()
+            elif info.si_signo in (signal.SIGTERM, signal.SIGINT, signal.SIGQUIT):
+                if running:
+                    self.logger.info('stopping')
+                running = False
+                for pid in list(self.workers) + ([self.cleaner] if self.cleaner else []):
+                    self.stop(pid, info.si_signo != signal.SIGQUIT)
+        self.logger.info('stopped')
+
+
+if __name__ == '__main__':
+    # benchmark: requests/s of a file served by 1 to 4 workers
+    import http.client
+    from tempfile import TemporaryDirectory
+
+    duration = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    nb_clients = 16
+
+    def client(port, deadline):
+        # a process per keep-alive connection, the clients must not be the bottleneck
+        count = 0
+        conn = http.client.HTTPConnection('127.0.0.1', port)
+        while time() < deadline:
+            conn.request('GET', '/img.jpeg')
+            conn.getresponse().read()
+            count += 1
+        return count
+
+    with TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, 'src.jpeg'), 'wb') as src:
+            src.write(os.urandom(20000))
+        with open(os.path.join(tmp, 'src.jpeg.META'), 'w') as meta:
+            meta.write('C|%d|3600||' % time())
+        with open(os.path.join(tmp, 'katana.conf'), 'w') as conf:
+            conf.write('cache_dir = %r\nipc_sock_path = %r\nrouting = [{"proxy": {"url_re": "/img.jpeg", '
+                       '"cache_path": "/src.jpeg", "origin": "none", "origin_tmpl": "/img.jpeg"}}]\n'
+                       'cache_default_expires = 3600\n' % (tmp, os.path.join(tmp, 'katana.sock')))
+        os.environ['CONFIG_FILE'] = os.path.join(tmp, 'katana.conf')
+        for nb_workers in (1, 2, 4):
+            sock = listen(('127.0.0.1', 0))
+            port = sock.getsockname()[1]
+            sock.close()
+            pid = os.fork()
+            if not pid:
+                supervisor = Supervisor(('127.0.0.1', port))
+                supervisor.config['server_workers'] = nb_workers
+                supervisor.run()
+                os._exit(0)
+            from time import sleep
+            sleep(2)
+            deadline = time() + duration
+            clients = []
+            for _ in range(nb_clients):
+                read_fd, write_fd = os.pipe()
+                client_pid = os.fork()
+                if not client_pid:
+                    try:
+                        os.close(read_fd)
+                        os.write(write_fd, str(client(port, deadline)).encode())
+                    finally:
+                        os._exit(0)
+                os.close(write_fd)
+                clients.append((client_pid, read_fd))
+            count = 0
+            for client_pid, read_fd in clients:
+                with os.fdopen(read_fd) as result:
+                    count += int(result.read() or 0)
+                os.waitpid(client_pid, 0)
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+            print('%d workers: %d requests/s, %d requests/s per worker' % (nb_workers, count / duration,
+                                                                           count / duration / nb_workers))
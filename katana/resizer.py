@@ -1,41 +1,272 @@
+import os
 import logging
-from PIL import Image, ImageOps
+from PIL import Image
 from math import ceil
 
+from .utils import LRUCache
+
 logger = logging.getLogger('katana.resizer')
 
+# resampling filter and reducing gap for every quality tier: the image is first reduced
+# (at decode time for JPEG) down to reducing_gap times the target size, then resampled.
+RESAMPLE = {
+    'fast': (Image.BILINEAR, 1.0),
+    'balanced': (Image.BICUBIC, 2.0),
+    'high': (Image.LANCZOS, 3.0),
+}
 
-def resize(src, dst, width=0, height=0, fit=True, quality=75):
-    try:
-        img = Image.open(src)
-    except IOError as e:
-        logger.error('resize %s: (%dx%d) corrupt image [%s]', src, width, height, e)
-        return False
 
-    origin_width, origin_height = img.size
-    if origin_height == origin_width == 0:
-        return False
+def fit_box(size, target):
+    '''Returns the centered box of size having the aspect ratio of target.'''
+    origin_width, origin_height = size
+    width, height = target
+    ratio = width / float(height)
+    if origin_width / float(origin_height) > ratio:
+        crop_width = origin_height * ratio
+        return ((origin_width - crop_width) / 2, 0, (origin_width + crop_width) / 2, origin_height)
+    crop_height = origin_width / ratio
+    return (0, (origin_height - crop_height) / 2, origin_width, (origin_height + crop_height) / 2)
+
+
+def thumbnail_size(size, target):
+    '''Returns the size of the image fitting in target while keeping its aspect ratio, never upscaling.'''
+    origin_width, origin_height = size
+    width, height = target
+    if origin_width <= width and origin_height <= height:
+        return size
+    ratio = min(width / float(origin_width), height / float(origin_height))
+    return max(1, int(round(origin_width * ratio))), max(1, int(round(origin_height * ratio)))
+
+
+# encoder settings of every format chosen for throughput, the quality comes from the request
+ENCODERS = {
+    'JPEG': {'optimize': False, 'progressive': False, 'subsampling': '4:2:0'},
+    'WEBP': {'method': 2},
+    'AVIF': {'speed': 8, 'subsampling': '4:2:0'},
+}
+
+
+def adequate_variant(variants, width, height, fit, quality, min_ratio=2.0):
+    '''Returns the path of the smallest variant a thumbnail can be resized from, or None.
+
+    variants is a dict of path => (size, cropped, quality). A variant must be at least
+    min_ratio times the thumbnail, with a quality not lower than the requested one, and
+    cropped variants are only used for a thumbnail of the same aspect ratio.
+    '''
+    best = None
+    for path, ((variant_width, variant_height), cropped, variant_quality) in variants.items():
+        if variant_quality < quality:
+            continue
+        if cropped:
+            # a crop can only be cropped again to the same aspect ratio
+            if not (fit and width and height) or abs(variant_width * height - variant_height * width) > max(width, height):
+                continue
+            large_enough = variant_width >= min_ratio * width
+        elif fit and width and height:
+            large_enough = variant_width >= min_ratio * width and variant_height >= min_ratio * height
+        else:
+            large_enough = (width and variant_width >= min_ratio * width) or (height and variant_height >= min_ratio * height)
+        if large_enough and (best is None or variant_width * variant_height < best[1]):
+            best = (path, variant_width * variant_height)
+    return best[0] if best else None
 
+
+def configure(decoded_cache_size=0, decoded_cache_ttl=10, encoders=None):
+    '''Sets the size in bytes of the cache of decoded sources, 0 disables it, and the encoder
+    settings overriding ENCODERS per format (eg: {'webp': {'method': 4}}).
+    '''
+    global decoded_cache, encoders_settings
+    decoded_cache = LRUCache(decoded_cache_size, decoded_cache_ttl, sizeof=lambda entry: entry[2])
+    encoders_settings = {fmt: dict(settings) for fmt, settings in ENCODERS.items()}
+    for fmt, settings in (encoders or {}).items():
+        encoders_settings.setdefault(fmt.upper(), {}).update(settings)
+
+
+def save(img, dst, quality):
+    '''Saves img to dst in the format of its extension with the encoder settings of the format.'''
+    fmt = Image.registered_extensions().get(os.path.splitext(dst)[1].lower())
+    img.save(dst, fmt, quality=quality, **encoders_settings.get(fmt, {}))
+
+
+decoded_cache = encoders_settings = None
+configure()
+
+
+def _target(origin_size, width, height, fit, reducing_gap):
+    '''Returns the size of a variant and the size the source must be decoded at to resize it.'''
+    origin_width, origin_height = origin_size
     if not width and height:
         width = int(ceil(origin_width / (float(origin_height) / height)))
     if not height and width:
         height = int(ceil(origin_height / (float(origin_width) / width)))
-
     if width != 0 and height != 0:
-        logger.debug('resize %s: (%dx%d) => (%dx%d) mode=%s quality=%d', src, origin_width, origin_height, width, height, 'fit' if fit else 'fill', quality)
         if fit:
-            img = ImageOps.fit(img, (width, height), Image.ANTIALIAS)
+            scale = max(width / float(origin_width), height / float(origin_height))
         else:
-            img = img.copy()
-            img.thumbnail((width, height), Image.ANTIALIAS)
+            scale = min(width / float(origin_width), height / float(origin_height))
+        scale = min(1, scale * reducing_gap)
     else:
-        logger.debug('no resize %s: (%dx%d) quality=%d', src, origin_width, origin_height, quality)
+        scale = 1
+    return (width, height), (int(ceil(origin_width * scale)), int(ceil(origin_height * scale)))
+
+
+def _decode(src, key, entry, img, needed):
+    '''Returns the source decoded at needed size at least, from decoded_cache if it is large enough.
+
+    img is the opened source, None if entry (the cached one) was found.
+    '''
+    if entry and entry[0].size[0] >= needed[0] and entry[0].size[1] >= needed[1]:
+        return entry[0]
+    if entry:
+        img = Image.open(src)
+    origin_size = img.size
+    if needed[0] < origin_size[0] and needed[1] < origin_size[1]:
+        img.draft('RGB', tuple(needed))
+    img.load()
+    decoded_cache.set(key, (img, origin_size, img.size[0] * img.size[1] * len(img.getbands())))
+    return img
+
 
+def _resized(img, origin_size, width, height, fit, method, reducing_gap):
+    '''Returns img resized to a variant of width x height.'''
+    if width == 0 or height == 0:
+        return img
+    if fit:
+        return img.resize((width, height), method, box=fit_box(img.size, (width, height)), reducing_gap=reducing_gap)
+    size = thumbnail_size(origin_size, (width, height))
+    return img.resize(size, method, reducing_gap=reducing_gap) if size != img.size else img
+
+
+def resize_many(src, variants, resample='high'):
+    '''Resizes src to several variants decoding it only once.
+
+    The source is decoded at the smallest scale covering every variant and kept in
+    decoded_cache, so the other sizes requested shortly after don't decode it again.
+
+    Args:
+        src (str): path of the source image.
+        variants (list): a list of (dst, width, height, fit, quality).
+        resample (str): the quality tier, see RESAMPLE.
+
+    Returns:
+        A list of bool, True for every variant successfully saved.
+    '''
+    img = None
     try:
-        if img.mode != "RGB":
-            img = img.convert("RGB")
-        img.save(dst, quality=quality)
+        st = os.stat(src)
+        key = (src, st.st_mtime_ns, st.st_size)
+        entry = decoded_cache.get(key)
+        if entry:
+            origin_size = entry[1]
+        else:
+            img = Image.open(src)
+            origin_size = img.size
     except IOError as e:
-        logger.error('error saving %s to %s: %s', src, dst, e)
-        return False
-    return True
+        logger.error('resize %s: corrupt image [%s]', src, e)
+        return [False] * len(variants)
+
+    origin_width, origin_height = origin_size
+    if origin_height == origin_width == 0:
+        return [False] * len(variants)
+
+    method, reducing_gap = RESAMPLE.get(resample, RESAMPLE['high'])
+    sizes = []
+    needed = [0, 0]
+    for _, width, height, fit, _ in variants:
+        size, decoded_size = _target(origin_size, width, height, fit, reducing_gap)
+        needed = [max(needed[0], decoded_size[0]), max(needed[1], decoded_size[1])]
+        sizes.append(size)
+
+    try:
+        img = _decode(src, key, entry, img, needed)
+    except IOError as e:
+        logger.error('resize %s: corrupt image [%s]', src, e)
+        return [False] * len(variants)
+
+    results = []
+    for (dst, _, _, fit, quality), (width, height) in zip(variants, sizes):
+        if width != 0 and height != 0:
+            logger.debug('resize %s: (%dx%d) => (%dx%d) mode=%s quality=%d resample=%s', src, origin_width, origin_height,
+                         width, height, 'fit' if fit else 'fill', quality, resample)
+        else:
+            logger.debug('no resize %s: (%dx%d) quality=%d', src, origin_width, origin_height, quality)
+        try:
+            resized = _resized(img, origin_size, width, height, fit, method, reducing_gap)
+            if resized.mode != "RGB":
+                resized = resized.convert("RGB")
+            save(resized, dst, quality)
+        except (IOError, ValueError) as e:
+            logger.error('error saving %s to %s: %s', src, dst, e)
+            results.append(False)
+        else:
+            results.append(True)
+    return results
+
+
+def resize(src, dst, width=0, height=0, fit=True, quality=75, resample='high'):
+    return resize_many(src, [(dst, width, height, fit, quality)], resample)[0]
+
+
+if __name__ == '__main__':
+    import sys
+    import resource
+    import tempfile
+    from time import time, process_time
+    from PIL import ImageOps
+
+    def resize_legacy(src, dst, width, height, fit=True, quality=75, resample=None):
+        img = Image.open(src)
+        img = ImageOps.fit(img, (width, height), Image.LANCZOS)
+        img.convert('RGB').save(dst, quality=quality)
+        return True
+
+    # usage: python -m katana.resizer [WIDTHxHEIGHT] [image ...]
+    size = sys.argv[1] if len(sys.argv) > 1 else '200x112'
+    width, height = [int(x) for x in size.split('x')]
+    tmp = tempfile.mkdtemp()
+    corpus = sys.argv[2:]
+    if not corpus:
+        for w, h in ((1280, 720), (1920, 1080), (4000, 3000)):
+            path = os.path.join(tmp, 'src-%dx%d.jpeg' % (w, h))
+            Image.radial_gradient('L').resize((w, h)).convert('RGB').save(path, quality=90)
+            corpus.append(path)
+
+    duration = 3
+    modes = [('legacy', resize_legacy, None)] + [(tier, resize, tier) for tier in ('fast', 'balanced', 'high')]
+    for name, func, tier in modes:
+        pid = os.fork()
+        if pid:
+            os.waitpid(pid, 0)
+            continue
+        count = 0
+        dst = os.path.join(tmp, 'dst.jpeg')
+        start = time()
+        while time() - start < duration:
+            for src in corpus:
+                func(src, dst, width, height, True, 75, tier)
+                count += 1
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        print('%-8s %dx%d: %.1f resizes/s, peak RSS %d KB' % (name, width, height, count / (time() - start), rss))
+        os._exit(0)
+
+    # bytes saved against CPU spent to encode the thumbnails in every format
+    from io import BytesIO
+    thumbs = []
+    for src in corpus:
+        img = Image.open(src)
+        thumbs.append(img.resize((width, height), Image.LANCZOS, box=fit_box(img.size, (width, height))).convert('RGB'))
+    reference = None
+    for fmt in ('JPEG', 'WEBP', 'AVIF'):
+        count = size = 0
+        start = process_time()
+        while process_time() - start < duration:
+            for thumb in thumbs:
+                out = BytesIO()
+                thumb.save(out, fmt, quality=75, **encoders_settings[fmt])
+                size += out.tell()
+                count += 1
+        cpu = (process_time() - start) / count
+        size = size / float(count)
+        reference = reference or (size, cpu)
+        print('%-8s %dx%d: %d bytes (%+.1f%%), %.2f ms CPU (x%.1f)' % (fmt.lower(), width, height, size,
+              (size / reference[0] - 1) * 100, cpu * 1000, cpu / reference[1]))
@@ -0,0 +1,256 @@
+import re
+from string import Formatter
+
+__all__ = ['Router']
+
+GROUP_RE = re.compile(r'\(\?P<[A-Za-z_]\w*>')
+# Patterns using back references, conditional groups or global inline flags
+# can't be safely merged in a combined alternation.
+NOT_COMBINABLE_RE = re.compile(r'\\\d|\(\?P=|\(\?\(|^\(\?[aiLmsux]+\)')
+
+ACTIONS = ('resize', 'proxy')
+CACHE_PATHS = ('cache_path', 'cache_path_source', 'cache_path_resized')
+
+
+def literal_prefix(pattern):
+    """Returns the literal string that any match of pattern must start with.
+
+    The scan is conservative: an empty string is returned as soon as the
+    pattern can't be proven to start with a literal.
+    """
+    depth = 0
+    in_class = False
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            i += 2
+            continue
+        if in_class:
+            if c == ']':
+                in_class = False
+        elif c == '[':
+            in_class = True
+        elif c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        elif c == '|' and not depth:
+            # top level alternation, there is no common prefix
+            return ''
+        i += 1
+
+    prefix = []
+    i = 1 if pattern.startswith('^') else 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            escaped = pattern[i + 1:i + 2]
+            if not escaped or escaped.isalnum():
+                break
+            c, step = escaped, 2
+        elif c in '.^$*+?{}[]|()':
+            break
+        else:
+            step = 1
+        if pattern[i + step:i + step + 1] in ('*', '?', '{'):
+            # the previous literal is optional or repeated
+            break
+        prefix.append(c)
+        i += step
+    return ''.join(prefix)
+
+
+class Template(object):
+    """A str.format template parsed once.
+
+    Templates only using plain named fields are rendered by joining the
+    literals with the values, others fall back to str.format.
+    """
+
+    def __init__(self, tmpl, prefix=''):
+        self.tmpl = prefix + tmpl
+        self.parts = []
+        for literal, field, spec, conversion in Formatter().parse(self.tmpl):
+            if field is not None and (spec or conversion or not field.isidentifier()):
+                self.parts = None
+                break
+            if literal:
+                self.parts.append((True, literal))
+            if field is not None:
+                self.parts.append((False, field))
+
+    def pattern(self):
+        """Returns a regex pattern matching the strings rendered from the template."""
+        parts = []
+        for literal, field, spec, conversion in Formatter().parse(self.tmpl):
+            parts.append(re.escape(literal))
+            if field is not None:
+                parts.append('.+?')
+        return ''.join(parts)
+
+    def format(self, values):
+        if self.parts is None:
+            return self.tmpl.format(**values)
+        return ''.join(part if literal else str(values[part]) for literal, part in self.parts)
+
+
+class Route(object):
+    """An action of a route with its compiled regex and templates."""
+
+    def __init__(self, index, route_index, action, ctx, cache_dir):
+        self.index = index
+        self.route_index = route_index
+        self.action = action
+        self.ctx = ctx
+        self.origin = ctx.get('origin')
+        self.url_re = ctx['url_re']
+        self.regex = re.compile(self.url_re)
+        self.prefix = literal_prefix(self.url_re)
+        self.combinable = not NOT_COMBINABLE_RE.search(self.url_re)
+        self.group_name = '_r%d' % index
+        self.templates = {}
+        for key, value in ctx.items():
+            if key == 'origin_tmpl' or key in CACHE_PATHS:
+                self.templates[key] = Template(value, cache_dir if key in CACHE_PATHS else '')
+
+    def combined_pattern(self):
+        """Returns the regex wrapped in a group identifying the route, its own named groups
+        are made anonymous to be unique in a combined alternation.
+        """
+        return '(?P<%s>%s)' % (self.group_name, GROUP_RE.sub('(', self.url_re))
+
+    def format(self, key, values):
+        return self.templates[key].format(values)
+
+
+class Segment(object):
+    """Consecutive candidate routes matched with a single regex."""
+
+    def __init__(self, routes):
+        self.routes = routes
+        self.by_group = {route.group_name: route for route in routes}
+        if len(routes) == 1:
+            self.regex = None
+        else:
+            self.regex = re.compile('|'.join(route.combined_pattern() for route in routes))
+
+
+class Router(object):
+    """Dispatches a path to the configured routes in a single pass.
+
+    Routes are compiled once: a trie on the literal prefix of every url_re
+    selects the candidate routes, then the candidates are matched with one
+    combined alternation regex. The first matching route wins, as with the
+    routing list order, and only this route's own regex is then used to
+    extract the values.
+    """
+
+    def __init__(self, routing, cache_dir=''):
+        self.routes = []
+        for route_index, route in enumerate(routing):
+            for action in ACTIONS:
+                ctx = route.get(action)
+                if ctx and ctx.get('url_re'):
+                    self.routes.append(Route(len(self.routes), route_index, action, ctx, cache_dir))
+
+        self.trie = {}
+        for route in self.routes:
+            node = self.trie
+            for c in route.prefix:
+                node = node.setdefault(c, {})
+            node.setdefault(None, []).append(route)
+        self._build(self.trie, [])
+
+    def _build(self, node, candidates):
+        candidates = sorted(candidates + node.get(None, []), key=lambda route: route.index)
+        segments = []
+        for route in candidates:
+            if route.combinable and segments and segments[-1][-1].combinable:
+                segments[-1].append(route)
+            else:
+                segments.append([route])
+        node[None] = candidates
+        node['segments'] = [Segment(routes) for routes in segments]
+        for c, child in list(node.items()):
+            if c not in (None, 'segments'):
+                self._build(child, candidates)
+
+    def match(self, path):
+        """Yields (route, values) for every route matching path in routing order.
+
+        Once a route has been yielded, the other actions of the same route are skipped.
+        """
+        node = self.trie
+        for c in path:
+            child = node.get(c)
+            if child is None:
+                break
+            node = child
+
+        last_route = None
+        for segment in node['segments']:
+            routes = segment.routes
+            if last_route is None and segment.regex:
+                match = segment.regex.match(path)
+                if not match:
+                    continue
+                route = segment.by_group[match.lastgroup]
+                yield route, route.regex.match(path).groupdict()
+                last_route = route.route_index
+                routes = routes[routes.index(route) + 1:]
+            for route in routes:
+                if last_route is not None and route.route_index <= last_route:
+                    continue
+                match = route.regex.match(path)
+                if match:
+                    yield route, match.groupdict()
+                    last_route = route.route_index
+
+
+if __name__ == '__main__':
+    import sys
+    from timeit import timeit
+
+    nb_routes = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    routing = []
+    for i in range(nb_routes):
+        routing.append({
+            'resize': {
+                'url_re': r'/type%d-(?P<object_id>[a-z0-9]+)-(?P<version>\d+)_(?P<width>\d{1,4})?x(?P<height>\d{1,4})?.(?P<thumb_ext>(?:jpeg|webp))' % i,
+                'origin_tmpl': '/{object_id}.jpg',
+                'cache_path_source': '/type%d/{object_id}-{version}/src.jpeg' % i,
+                'cache_path_resized': '/type%d/{object_id}-{version}/{width}x{height}.{thumb_ext}' % i,
+            },
+            'proxy': {
+                'url_re': r'/type%d-(?P<object_id>[a-z0-9]+)-(?P<version>\d+)(?:.jpeg)?' % i,
+                'origin_tmpl': '/{object_id}.jpg',
+                'cache_path': '/type%d/{object_id}-{version}/src.jpeg' % i,
+            },
+        })
+    router = Router(routing)
+
+    def legacy(path):
+        for route in routing:
+            for action in ACTIONS:
+                ctx = route.get(action)
+                if ctx and ctx.get('url_re'):
+                    match = re.match(ctx['url_re'], path)
+                    if match:
+                        return action, match.groupdict()
+
+    def compiled(path):
+        for route, values in router.match(path):
+            return route.action, values
+
+    paths = {
+        'first': '/type0-abc123-1_200x112.jpeg',
+        'last': '/type%d-abc123-1_200x112.jpeg' % (nb_routes - 1),
+        'miss': '/unknown/path.jpeg',
+    }
+    number = 20000
+    for name, path in sorted(paths.items()):
+        assert legacy(path) == compiled(path), path
+        t_legacy = timeit(lambda: legacy(path), number=number) / number * 1e6
+        t_compiled = timeit(lambda: compiled(path), number=number) / number * 1e6
+        print('%-6s legacy=%.2fus compiled=%.2fus speedup=x%.1f' % (name, t_legacy, t_compiled, t_legacy / t_compiled))
@@ -1,21 +1,34 @@
 from gevent import monkey; monkey.patch_all() # flake8: noqa
 
+import io
 import os
-import re
 import errno
-import urllib.request, urllib.error, urllib.parse
+import tempfile
+import http.client
 import logging
 from time import time, strptime, mktime
 from datetime import datetime
 from functools import partial
+from contextlib import ExitStack
+
+import gevent
+from gevent import getcurrent
+from PIL import Image, features
 
 from . import __version__
 from .config import get_config
-from .resizer import resize
+from . import resizer
+from .executor import ResizeExecutor, ResizeBusy
 from .httpwhohas import HttpWhoHas
-from .utils import Timer, wlock
+from .httppool import HTTPPool, PoolFullError
+from .utils import Timer, SingleFlight, TeeStream, LRUCache, negotiate_format, variant_etag, wlock
 from .meta import Meta
-from .ipc import IPC
+from .negcache import NegativeCache
+from .routing import Router
+from .wsgi import FileWrapper, parse_range
+from .ipc import IPC, EventAggregator
+from .hotcache import HotCache
+from . import metrics
 
 
 USER_AGENT = 'Katana/%s' % __version__
@@ -32,109 +45,446 @@ class Server(object):
         self.logger = logging.getLogger('katana.server')
 
         self.meta = Meta()
-        self.ipc = IPC(self.config['ipc_sock_path'])
+        self.ipc = IPC(self.config['ipc_sock_path'], self.config['ipc_hwm'], self.config['ipc_drop_policy'],
+                       self.config['ipc_sample_rate'])
+        self.events = EventAggregator(self.ipc, self.config['ipc_push_window'], self.config['ipc_push_batch_size'])
+        self.router = Router(self.config['routing'], self.config['cache_dir'])
+        # the flock of wlock only coordinates with the other processes
+        self.singleflight = SingleFlight()
+
+        resizer_config = {
+            'decoded_cache_size': self.config['decoded_cache_size'],
+            'decoded_cache_ttl': self.config['decoded_cache_ttl'],
+            'encoders': self.config['thumb_encoders'],
+        }
+        if self.config['resize_workers']:
+            self.resizer = ResizeExecutor(self.config['resize_workers'], self.config['resize_queue_size'],
+                                          self.config['resize_timeout'], self.config['logging'], resizer_config)
+        else:
+            resizer.configure(**resizer_config)
+            self.resizer = resizer
+
+        # source => {variant: (size, cropped, quality)} of the variants resized from the source
+        self.variants = LRUCache(self.config['thumb_variants_index_size'] if self.config['thumb_from_variants'] else 0)
+
+        # small and frequently served files are kept in memory, there is no file to serve with accel_redirect
+        external_expires = self.config['external_expires'] if isinstance(self.config['external_expires'], int) else None
+        self.hot = HotCache(0 if self.config['accel_redirect'] else self.config['hot_cache_size'],
+                            self.config['hot_cache_max_object_size'], self.config['hot_cache_min_hits'], external_expires)
+        if self.hot.max_size:
+            gevent.spawn(self._invalidate_hot)
+
+        # the formats that can be negotiated with the clients
+        self.formats = set()
+        for fmt in ('avif', 'webp'):
+            if features.check(fmt):
+                self.formats.add(fmt)
+            else:
+                self.logger.warning('%s is not supported by Pillow and won\'t be negotiated', fmt)
+
+        self.not_found = NegativeCache(self.config['negative_cache_size'], self.config['negative_cache_ttl'],
+                                       self.config['negative_cache_db_path'])
+
+        # the pool is shared by the resolvers and the fetches
+        self.pool = HTTPPool(self.config['origin_pool_size'], self.config['origin_pool_idle_timeout'], self.config['proxy'])
 
         self.hws = {}
         for o_name, o_conf in list(self.config['origins'].items()):
-            self.hws[o_name] = HttpWhoHas(proxy=self.config['proxy'], timeout=self.config['origin_timeout'], user_agent=USER_AGENT)
+            method = 'GET' if o_name in self.config['origins_resolve_with_get'] else 'HEAD'
+            self.hws[o_name] = HttpWhoHas(timeout=self.config['origin_timeout'], user_agent=USER_AGENT, pool=self.pool, method=method,
+                                          max_failures=self.config['origin_eject_failures'], eject_time=self.config['origin_eject_time'])
             for c_name, c_conf in list(o_conf.items()):
                 self.hws[o_name].set_cluster(c_name, c_conf['ips'], c_conf.get('headers'))
 
-    def _get_cache(self, cache):
+        if self.config['metrics_dir']:
+            gevent.spawn(self._dump_metrics)
+
+        # the expired files being revalidated in the background
+        self.revalidating = set()
+
+    def _invalidate_hot(self):
+        """Deletes the files deleted by the cleaner from the hot cache."""
+        while True:
+            event = self.ipc.subscribe()
+            if event.name == 'DELETE':
+                self.hot.delete(event.path)
+                self.meta.invalidate(event.path)
+
+    def _get_cache(self, cache, kind='source'):
         if os.path.exists(cache):
             if os.path.getsize(cache):
-                self.ipc.push('CACHE-OUT %s' % cache)
+                self.events.add('CACHE-OUT', cache, kind)
                 return cache
             else:
                 os.unlink(cache)
+        self.meta.invalidate(cache)
         return None
 
-    def get_file(self, origin_name, origin_path, cache):
+    def get_file(self, origin_name, origin_path, cache, tee=False):
+        """Returns (cache, meta, stream) for the file at origin_path on origin_name.
+
+        With tee, a file fetched from the origin is not downloaded before returning:
+        stream is a TeeStream sending the response while writing it to the cache, to
+        be consumed by the caller. Concurrent callers wait until it is fully written.
+        """
+        start = time()
+        image, meta, stream = self.singleflight.do(cache, self._get_file, origin_name, origin_path, cache, tee)
+        metrics.observe('katana_get_file_seconds', time() - start, origin=origin_name)
+        if stream and stream.owner is not getcurrent():
+            if not stream.done.get():
+                return None, {}, None
+            stream = None
+        return image, meta, stream
+
+    def _get_file(self, origin_name, origin_path, cache, tee):
         try:
             os.makedirs(os.path.dirname(cache))
         except OSError as exc:
             if exc.errno not in (errno.EEXIST, errno.ENOENT):
                 raise
 
-        with wlock(cache) as (write, exists, cache_fd):
+        with ExitStack() as lock:
+            write, exists, cache_fd = lock.enter_context(wlock(cache))
+            if not exists:
+                # the file may have been deleted by the cleaner
+                self.meta.invalidate(cache)
             meta = self.meta.get(cache)
+            stale_if_error = False
             if write and 'expires' in meta:
-                # If we have expires info in meta we check if we need to update (write) or not
-                expires = meta['expires']
-                if isinstance(self.config['external_expires'], int):
-                    expires = min(self.config['external_expires'], expires)
-                if time() > (meta['timestamp'] + expires):
-                    self.logger.debug('%s expired', cache)
-                else:
-                    write = False
-                    self.logger.debug('%s not expired', cache)
+                write, stale_if_error = self._expired(origin_name, origin_path, cache, meta, exists)
             if write:
-                self.logger.debug('resolving %s on %s', origin_path, origin_name)
-                try:
-                    hws = self.hws[origin_name]
-                except KeyError:
-                    self.logger.error('origin name %s not found in configuration file', origin_name)
-                    return None, {}
-                info = hws.resolve(origin_path, etag=meta.get('etag'), last_modified=meta.get('last_modified'))
-                if info:
-                    url = info['url']
-                    if not info['modified']:
-                        self.logger.debug('url=%s not modified', url)
-                        self.ipc.push('CACHE-OUT %s' % cache)
-                        headers = {
-                            'etag': meta.get('etag'),
-                            'last-modified': meta.get('last_modified'),
-                            'cache-control': info['headers'].get('cache-control'),
-                            }
-                        return cache, self.meta.set(cache, headers)
-                    headers = {'User-Agent': USER_AGENT}
-                    if info['host']:
-                        headers['Host'] = info['host']
-                    try:
-                        req = urllib.request.Request(url, headers=headers)
-                        resp = urllib.request.urlopen(req, timeout=self.config['origin_fetch_timeout'])
-                    except (urllib.error.HTTPError, urllib.error.URLError) as exc:
-                        self.logger.error('fetching url=%s error: %s', url, exc)
-                    except Exception as exc:
-                        self.logger.exception('fetching url=%s failed', url)
-                    else:
-                        meta = self.meta.set(cache, dict(resp.headers))
-                        while True:
-                            chunk = resp.read(self.config['chunk_size'])
-                            if not chunk:
-                                break
-                            cache_fd.write(chunk)
-                        self.logger.debug('fetched %s to %s', url, cache)
-                        self.ipc.push('CACHE-IN %s' % cache)
-                        return cache, meta
-                else:
-                    self.logger.debug('%s not found on origin %s ', cache, origin_name)
-
+                return self._fetch(origin_name, origin_path, cache, meta, cache_fd, lock, tee, stale_if_error)
             elif self._get_cache(cache):
                 self.logger.debug('%s found in cache as %s', origin_path, cache)
-                return cache, meta
-
-        return None, {}
+                metrics.inc('katana_cache_requests_total', origin=origin_name, result='hit')
+                return cache, meta, None
+
+        return None, {}, None
+
+    def _expired(self, origin_name, origin_path, cache, meta, exists):
+        """Returns whether cache must be fetched from its origin, and whether its stale copy may be
+        served if the origin fails.
+
+        An expired file still in its stale-while-revalidate window is served stale while it is
+        revalidated in the background.
+        """
+        expires = meta['expires']
+        if isinstance(self.config['external_expires'], int):
+            expires = min(self.config['external_expires'], expires)
+        expired = time() - (meta['timestamp'] + expires)
+        if expired <= 0:
+            self.logger.debug('%s not expired', cache)
+            return False, False
+        self.logger.debug('%s expired', cache)
+        if exists and expired <= meta['stale_while_revalidate']:
+            self._revalidate_later(origin_name, origin_path, cache)
+            return False, False
+        return True, exists and expired <= meta['stale_if_error']
+
+    def _fetch(self, origin_name, origin_path, cache, meta, cache_fd, lock, tee, stale_if_error):
+        """Fetches cache from its origin to cache_fd, locked by lock, see _get_file."""
+        self.logger.debug('resolving %s on %s', origin_path, origin_name)
+        try:
+            hws = self.hws[origin_name]
+        except KeyError:
+            self.logger.error('origin name %s not found in configuration file', origin_name)
+            return None, {}, None
+        if self.not_found.get(origin_name, origin_path):
+            self.logger.debug('%s recently not found on origin %s', origin_path, origin_name)
+            metrics.inc('katana_cache_requests_total', origin=origin_name, result='not_found')
+            return None, {}, None
+        start = time()
+        statuses = []
+        info = hws.resolve(origin_path, etag=meta.get('etag'), last_modified=meta.get('last_modified'), statuses=statuses)
+        metrics.observe('katana_origin_resolve_seconds', time() - start, origin=origin_name)
+        if info:
+            url = info['url']
+            resp = info.get('response')
+            if not info['modified']:
+                if resp:
+                    resp.close()
+                self.logger.debug('url=%s not modified', url)
+                self.events.add('CACHE-OUT', cache)
+                metrics.inc('katana_cache_requests_total', origin=origin_name, result='revalidated')
+                return cache, self._not_modified(cache, meta, info), None
+            try:
+                resp = self._origin_response(info)
+            except (http.client.HTTPException, OSError, PoolFullError) as exc:
+                self.logger.error('fetching url=%s error: %s', url, exc)
+                metrics.inc('katana_cache_requests_total', origin=origin_name, result='error')
+            except Exception as exc:
+                self.logger.exception('fetching url=%s failed', url)
+                metrics.inc('katana_cache_requests_total', origin=origin_name, result='error')
+            else:
+                if resp.status != 200:
+                    self.logger.error('fetching url=%s returned code %d', url, resp.status)
+                    resp.close()
+                    metrics.inc('katana_cache_requests_total', origin=origin_name, result='error')
+                    if stale_if_error and resp.status >= 500:
+                        return self._stale(origin_name, cache, meta)
+                    return None, {}, None
+                metrics.inc('katana_cache_requests_total', origin=origin_name, result='miss')
+                meta = self.meta.set(cache, resp.headers)
+                if tee:
+                    self.logger.debug('streaming %s to %s', url, cache)
+                    stream = TeeStream(resp, cache_fd, lock.pop_all(), self.config['chunk_size'],
+                                       partial(self._fetched, url, cache))
+                    return cache, meta, stream
+                try:
+                    while True:
+                        chunk = resp.read(self.config['chunk_size'])
+                        if not chunk:
+                            break
+                        cache_fd.write(chunk)
+                finally:
+                    resp.close()
+                self._fetched(url, cache, True)
+                return cache, meta, None
+            if stale_if_error:
+                return self._stale(origin_name, cache, meta)
+        elif stale_if_error and not any(status < 500 for status in statuses):
+            # no node answered, or only with server errors
+            return self._stale(origin_name, cache, meta)
+        elif statuses and all(status == 404 for status in statuses):
+            self.logger.debug('%s not found on origin %s ', cache, origin_name)
+            self.not_found.set(origin_name, origin_path)
+            metrics.inc('katana_cache_requests_total', origin=origin_name, result='not_found')
+        else:
+            # an outage of the origin must not be cached as a 404
+            self.logger.error('%s not resolved on origin %s: %s', origin_path, origin_name, statuses or 'no answer')
+            metrics.inc('katana_cache_requests_total', origin=origin_name, result='error')
+        return None, {}, None
+
+    def _origin_response(self, info):
+        """Returns the response of the origin to the GET request of the file resolved in info."""
+        resp = info.get('response')
+        if resp:
+            # the resolver already sent the GET request
+            resp.settimeout(self.config['origin_fetch_timeout'])
+            return resp
+        headers = {'User-Agent': USER_AGENT}
+        if info['host']:
+            headers['Host'] = info['host']
+        return self.pool.request('GET', info['ip'], info['path'], headers, timeout=self.config['origin_fetch_timeout'])
+
+    def _not_modified(self, cache, meta, info):
+        """Updates and returns the metadata of cache revalidated on the origin."""
+        headers = {
+            'etag': meta.get('etag'),
+            'last-modified': meta.get('last_modified'),
+            'cache-control': info['headers'].get('cache-control'),
+            }
+        return self.meta.set(cache, headers)
+
+    def _stale(self, origin_name, cache, meta):
+        """Returns the expired file cache when its origin fails."""
+        if self._get_cache(cache):
+            self.logger.warning('origin %s failed, serving %s stale', origin_name, cache)
+            metrics.inc('katana_cache_requests_total', origin=origin_name, result='stale')
+            return cache, meta, None
+        return None, {}, None
+
+    def _revalidate_later(self, origin_name, origin_path, cache):
+        if cache not in self.revalidating:
+            self.revalidating.add(cache)
+            gevent.spawn(self._revalidate, origin_name, origin_path, cache)
+
+    def _revalidate(self, origin_name, origin_path, cache):
+        """Revalidates the expired file cache on its origin while its stale copy is served.
+
+        A modified file is downloaded to a temporary file renamed under the exclusive lock of
+        cache, waited for at most origin_fetch_timeout seconds, the requests keep being served
+        the stale copy in the meantime.
+        """
+        tmp = None
+        try:
+            meta = self.meta.get(cache)
+            start = time()
+            info = self.hws[origin_name].resolve(origin_path, etag=meta.get('etag'), last_modified=meta.get('last_modified'))
+            metrics.observe('katana_origin_resolve_seconds', time() - start, origin=origin_name)
+            if not info:
+                self.logger.warning('%s not revalidated on origin %s', origin_path, origin_name)
+                return
+            if not info['modified']:
+                if info.get('response'):
+                    info['response'].close()
+                self.logger.debug('url=%s not modified', info['url'])
+                metrics.inc('katana_cache_requests_total', origin=origin_name, result='revalidated')
+                self._not_modified(cache, meta, info)
+                return
+
+            resp = self._origin_response(info)
+            try:
+                if resp.status != 200:
+                    self.logger.error('fetching url=%s returned code %d', info['url'], resp.status)
+                    return
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache), prefix='.revalidate-')
+                os.fchmod(fd, 0o644)
+                with os.fdopen(fd, 'wb') as tmp_fd:
+                    while True:
+                        chunk = resp.read(self.config['chunk_size'])
+                        if not chunk:
+                            break
+                        tmp_fd.write(chunk)
+            finally:
+                resp.close()
+            # the requests only hold the lock for a moment, wait for it to replace the file
+            deadline = time() + self.config['origin_fetch_timeout']
+            while tmp:
+                with wlock(cache) as (write, exists, cache_fd):
+                    if write:
+                        os.rename(tmp, cache)
+                        tmp = None
+                        self.meta.set(cache, resp.headers)
+                        self.hot.delete(cache)
+                        self.events.add('CACHE-IN', cache)
+                        metrics.inc('katana_cache_requests_total', origin=origin_name, result='miss')
+                        self.logger.debug('fetched %s to %s', info['url'], cache)
+                        break
+                if time() > deadline:
+                    self.logger.warning('%s still locked after %ds, download of url=%s discarded', cache,
+                                        self.config['origin_fetch_timeout'], info['url'])
+                    metrics.inc('katana_cache_requests_total', origin=origin_name, result='error')
+                    break
+                gevent.sleep(0.05)
+        except Exception:
+            self.logger.exception('revalidating %s on origin %s failed', origin_path, origin_name)
+        finally:
+            self.revalidating.discard(cache)
+            if tmp:
+                os.unlink(tmp)
+
+    def _fetched(self, url, cache, complete):
+        self.hot.delete(cache)
+        if complete:
+            self.logger.debug('fetched %s to %s', url, cache)
+            self.events.add('CACHE-IN', cache)
+        else:
+            self.logger.error('fetching url=%s to %s interrupted', url, cache)
+            self.meta.delete(cache)
 
-    def get_image_resized(self, image_src, cache, width, height, fit, quality, meta_src):
+    def get_image_resized(self, image_src, cache, width, height, fit, quality, meta_src, resample='high', extras=()):
         if not image_src and not self.config['not_found_as_200']:
             return None, {}
+        return self.singleflight.do(cache, self._get_image_resized, image_src, cache, width, height, fit, quality, meta_src,
+                                    resample, extras)
 
+    def _get_image_resized(self, image_src, cache, width, height, fit, quality, meta_src, resample, extras):
         with wlock(cache) as (write, exists, cache_fd):
+            if not exists:
+                self.meta.invalidate(cache)
             if image_src and write and (not exists or self.meta.get(cache) != meta_src):
-                if not resize(image_src, cache, width, height, fit, quality):
-                    return None, {}
+                extras = self._missing_variants(extras)
+                variant_src = None if extras else self._variant_source(image_src, width, height, fit, quality, meta_src)
+                start = time()
+                if variant_src:
+                    self.logger.debug('resize %s from the variant %s', cache, variant_src)
+                    ok = self.resizer.resize(variant_src, cache, width, height, fit, quality, resample)
+                    metrics.observe('katana_resize_seconds', time() - start, source='variant')
+                    if not ok:
+                        return None, {}
+                else:
+                    variants = [(cache, width, height, fit, quality)] + [variant for _, variant in extras]
+                    try:
+                        results = self.resizer.resize_many(image_src, variants, resample)
+                    except BaseException:
+                        # eg: ResizeBusy, the temporary files of the variants are not handed to _pregenerated
+                        for path, variant in extras:
+                            self._unlink(variant[0])
+                        raise
+                    metrics.observe('katana_resize_seconds', time() - start, source='original')
+                    for (path, variant), ok in zip(extras, results[1:]):
+                        self._pregenerated(image_src, path, variant, ok)
+                    if not results[0]:
+                        return None, {}
+                    self._index_variant(image_src, cache, width, height, fit, quality)
                 self.meta.copy(image_src, cache)
+                self.hot.delete(cache)
             elif write and not exists:
-                if not resize(self.config['not_found_source'], cache, width, height, fit, quality):
+                start = time()
+                ok = self.resizer.resize(self.config['not_found_source'], cache, width, height, fit, quality, resample)
+                metrics.observe('katana_resize_seconds', time() - start, source='not_found')
+                if not ok:
                     return None, {}
 
-            if self._get_cache(cache):
+            if self._get_cache(cache, 'resized'):
                 return cache, meta_src
 
         return None, {}
 
-    def resize(self, ctx, values):
+    def _missing_variants(self, extras):
+        """Returns (path, variant) for the variants not cached yet, variant being written to a temporary file."""
+        variants = []
+        for path, width, height, fit, quality in extras:
+            if os.path.exists(path):
+                continue
+            try:
+                if not os.path.exists(os.path.dirname(path)):
+                    os.makedirs(os.path.dirname(path))
+                fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.pregen-', suffix=os.path.splitext(path)[1])
+            except OSError as exc:
+                if exc.errno != errno.EEXIST:
+                    self.logger.error('cannot pregenerate %s: %s', path, exc)
+                continue
+            os.fchmod(fd, 0o644)
+            os.close(fd)
+            variants.append((path, (tmp, width, height, fit, quality)))
+        return variants
+
+    def _pregenerated(self, image_src, path, variant, ok):
+        # a variant requested in the meantime was written under its own lock, keep it
+        tmp, width, height, fit, quality = variant
+        if ok and not os.path.exists(path):
+            # the metadata first: the file must not be found without them
+            self.meta.copy(image_src, path)
+            os.rename(tmp, path)
+            self._index_variant(image_src, path, width, height, fit, quality)
+            self.hot.delete(path)
+            self.events.add('CACHE-IN', path, 'resized')
+            self.logger.debug('pregenerated %s from %s', path, image_src)
+        else:
+            self._unlink(tmp)
+
+    def _unlink(self, path):
+        try:
+            os.unlink(path)
+        except OSError as exc:
+            if exc.errno != errno.ENOENT:
+                self.logger.error('cannot remove %s: %s', path, exc)
+
+    def _index_variant(self, image_src, path, width, height, fit, quality):
+        """Remembers a variant resized from image_src, the variants resized from another variant are not
+        indexed to avoid stacking the resampling losses.
+        """
+        if not self.config['thumb_from_variants']:
+            return
+        try:
+            with Image.open(path) as img:
+                size = img.size
+        except IOError as exc:
+            self.logger.error('cannot index the variant %s: %s', path, exc)
+            return
+        variants = self.variants.get(image_src)
+        if variants is None:
+            variants = {}
+            self.variants.set(image_src, variants)
+        variants[path] = (size, bool(fit and width and height), quality)
+
+    def _variant_source(self, image_src, width, height, fit, quality, meta_src):
+        """Returns the smallest indexed variant of image_src that width x height can be resized from."""
+        variants = self.variants.get(image_src) if self.config['thumb_from_variants'] else None
+        while variants:
+            path = resizer.adequate_variant(variants, width, height, fit, quality, self.config['thumb_variant_min_ratio'])
+            if not path:
+                return None
+            # the variant may have been cleaned or resized from a newer source since it was indexed
+            if os.path.exists(path) and self.meta.get(path) == meta_src:
+                return path
+            del variants[path]
+        return None
+
+    def _thumb_values(self, values):
+        """Normalizes width, height, quality and fit in values and returns them."""
         width = values.get('width')
         width = int(width) if width else 0
         width = min(width, self.config['thumb_max_width'])
@@ -155,28 +505,234 @@ class Server(object):
             'fit': '1' if fit else '0',
             'quality': quality,
             })
-
-        origin_name = ctx['origin']
-        origin_path = ctx['origin_tmpl'].format(**values)
-        cache_source = '%s%s' % (self.config['cache_dir'], ctx['cache_path_source'].format(**values))
-        image_src, meta = self.get_file(origin_name, origin_path, cache_source)
-
-        cache_resized = '%s%s' % (self.config['cache_dir'], ctx['cache_path_resized'].format(**values))
-        image_resized, meta = self.get_image_resized(image_src, cache_resized, width, height, fit, quality, meta)
-        return image_resized, meta
-
-    def proxy(self, ctx, values):
-        origin_name = ctx['origin']
-        origin_path = ctx['origin_tmpl'].format(**values)
-        cache = '%s%s' % (self.config['cache_dir'], ctx['cache_path'].format(**values))
-        image, meta = self.get_file(origin_name, origin_path, cache)
+        return width, height, fit, quality
+
+    def _negotiated_path(self, route, values, path, accept):
+        """Returns path in the format preferred by the client among the negotiated formats of the route,
+        only JPEG thumbnails are negotiated.
+        """
+        ext = os.path.splitext(path)[1][1:].lower()
+        if ext not in ('jpeg', 'jpg'):
+            return path
+        formats = [fmt for fmt in route.ctx.get('negotiate', ()) if fmt in self.formats]
+        fmt = negotiate_format(accept, formats)
+        if not fmt:
+            return path
+        if 'thumb_ext' in values:
+            path = route.format('cache_path_resized', dict(values, thumb_ext=fmt))
+        # the format is part of the cache key even if the template doesn't use thumb_ext
+        if not path.endswith('.' + fmt):
+            path = '%s.%s' % (path, fmt)
+        return path
+
+    def resize(self, route, values, tee=False, accept=''):
+        captured = dict(values)
+        width, height, fit, quality = self._thumb_values(values)
+
+        origin_name = route.origin
+        origin_path = route.format('origin_tmpl', values)
+        cache_source = route.format('cache_path_source', values)
+        cache_resized = route.format('cache_path_resized', values)
+        negotiated = None
+        if accept and route.ctx.get('negotiate'):
+            path = self._negotiated_path(route, values, cache_resized, accept)
+            if path != cache_resized:
+                negotiated, cache_resized = path.rsplit('.', 1)[-1], path
+
+        hot = self.hot.get(cache_resized)
+        if hot:
+            self.events.add('CACHE-OUT', cache_source)
+            self.events.add('CACHE-OUT', cache_resized, 'resized')
+            return cache_resized, hot[1], hot[0]
+
+        image_src, meta, _ = self.get_file(origin_name, origin_path, cache_source)
+        resample = route.ctx.get('resample', self.config['thumb_resample'])
+        extras = []
+        for variant in route.ctx.get('pregenerate', ()):
+            variant_values = dict(captured, **variant)
+            variant = self._thumb_values(variant_values)
+            path = route.format('cache_path_resized', variant_values)
+            if path != cache_resized:
+                extras.append((path,) + variant)
+        image_resized, meta = self.get_image_resized(image_src, cache_resized, width, height, fit, quality, meta, resample, extras)
+        if negotiated and meta.get('etag'):
+            # served with Vary: Accept, every format needs its own ETag; the metadata of the variant
+            # keep the one of the source to tell when it must be resized again
+            meta = dict(meta, etag=variant_etag(meta['etag'], negotiated))
+        return image_resized, meta, None
+
+    def proxy(self, route, values, tee=False, accept=''):
+        origin_name = route.origin
+        origin_path = route.format('origin_tmpl', values)
+        cache = route.format('cache_path', values)
+        hot = self.hot.get(cache)
+        if hot:
+            self.events.add('CACHE-OUT', cache)
+            return cache, hot[1], hot[0]
+        image, meta, stream = self.get_file(origin_name, origin_path, cache, tee)
         if not image and self.config['not_found_as_200']:
             image = self.config['not_found_source']
-        return image, meta
+        return image, meta, stream
+
+    def _serve_file(self, environ, start_response, image_dst, meta, headers, data=None):
+        """Serves image_dst, or data if it is the content of image_dst from the hot cache."""
+        if data is None:
+            try:
+                image = open(image_dst, 'rb')
+            except IOError as exc:
+                self.logger.error('can\'t open %s: %s', image_dst, exc)
+                start_response('404 Not Found', headers)
+                return []
+            size = os.fstat(image.fileno()).st_size
+            if self.hot.admissible(image_dst, size, meta):
+                with image:
+                    data = image.read()
+                self.hot.add(image_dst, data, meta)
+        if data is not None:
+            image = io.BytesIO(data)
+            size = len(data)
+        headers.append(('Accept-Ranges', 'bytes'))
+
+        ranges = None
+        if environ.get('HTTP_RANGE'):
+            if_range = environ.get('HTTP_IF_RANGE')
+            if not if_range or if_range in (meta.get('etag'), meta.get('last_modified')):
+                ranges = parse_range(environ['HTTP_RANGE'], size)
+
+        if ranges == []:
+            image.close()
+            headers.append(('Content-Range', 'bytes */%d' % size))
+            start_response('416 Range Not Satisfiable', headers)
+            return []
+        elif ranges and len(ranges) == 1:
+            start, end = ranges[0]
+            body = FileWrapper(image, self.config['chunk_size'], [(b'', start, end - start + 1)])
+            headers.append(('Content-Range', 'bytes %d-%d/%d' % (start, end, size)))
+            status = '206 Partial Content'
+        elif ranges:
+            body, content_type = FileWrapper.ranges(image, self.config['chunk_size'], ranges, size, headers[0][1])
+            headers[0] = ('Content-Type', content_type)
+            status = '206 Partial Content'
+        elif data is not None:
+            body = [data]
+            status = '200 OK'
+        else:
+            body = environ.get('wsgi.file_wrapper', FileWrapper)(image, self.config['chunk_size'])
+            status = '200 OK'
+
+        headers.append(('Content-Length', str(body.length if isinstance(body, FileWrapper) else size)))
+        if data is not None and isinstance(body, FileWrapper):
+            # the ranges of data, the socket can't sendfile from memory
+            body = list(body)
+        start_response(status, headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            image.close()
+            return []
+        return body
+
+    def _collect_metrics(self):
+        """Sets the gauges of the counters kept by the components of the server."""
+        for name, value in self.ipc.stats().items():
+            metrics.gauge('katana_ipc_events', value, result=name)
+        for name, value in self.meta.stats().items():
+            metrics.gauge('katana_meta_cache', value, stat=name)
+        for name, value in self.hot.stats().items():
+            metrics.gauge('katana_hot_cache', value, stat=name)
+        for name, value in self.not_found.stats().items():
+            metrics.gauge('katana_negative_cache', value, stat=name)
+        for origin_name, hws in self.hws.items():
+            for node, stats in hws.stats().items():
+                for name, value in stats.items():
+                    if name != 'ejected_until':
+                        metrics.gauge('katana_origin_node', int(value) if isinstance(value, bool) else value,
+                                      origin=origin_name, node=node, stat=name)
+
+    def _dump_metrics(self):
+        while True:
+            gevent.sleep(self.config['metrics_interval'])
+            self._collect_metrics()
+            try:
+                metrics.REGISTRY.dump(self.config['metrics_dir'])
+            except (IOError, OSError) as exc:
+                self.logger.error('cannot dump the metrics in %s: %s', self.config['metrics_dir'], exc)
+
+    def _serve_metrics(self, start_response):
+        self._collect_metrics()
+        body = metrics.REGISTRY.render(self.config['metrics_dir']).encode('utf8')
+        start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'), ('Content-Length', str(len(body)))])
+        return [body]
+
+    def _measured(self, start_response, timer, labels):
+        """Returns start_response counting the responses and their latency by route, action and origin."""
+        def measured_start_response(status, headers, exc_info=None):
+            metrics.inc('katana_requests_total', status=status[:3], **labels)
+            metrics.observe('katana_request_seconds', time() - timer.start, **labels)
+            return start_response(status, headers, exc_info) if exc_info else start_response(status, headers)
+        return measured_start_response
+
+    def _respond(self, environ, start_response, route, timer, image_dst, meta, stream, client_etag, client_modified_ts):
+        """Sends image_dst, its content is read from stream (a TeeStream or the bytes from the hot cache) if any."""
+        request_method = environ['REQUEST_METHOD']
+        data = None
+        if isinstance(stream, bytes):
+            # the content of image_dst from the hot cache
+            data, stream = stream, None
+        ext = image_dst.rsplit('.', 1)[-1]
+        headers = [('Content-Type', 'image/%s' % ext), ('X-Response-Time', str(timer)), ]
+        if route.ctx.get('negotiate'):
+            headers.append(('Vary', 'Accept'))
+
+        client_not_modified = False
+        if meta.get('etag'):
+            headers.append(('ETag', meta['etag']))
+            if client_etag:
+                client_not_modified = client_etag == meta['etag']
+        if meta.get('last_modified'):
+            headers.append(('Last-Modified', meta['last_modified']))
+            if not client_not_modified and client_modified_ts:
+                client_not_modified = date_to_ts(meta['last_modified']) <= client_modified_ts
+
+        expires = meta.get('expires', 0)
+        if isinstance(self.config['external_expires'], int):
+            expires = max(self.config['external_expires'],  expires)
+        if expires:
+            now = time()
+            timestamp_expires = meta.get('timestamp', now) + expires
+            if timestamp_expires < now:
+                # served stale, see stale_while_revalidate and stale_if_error
+                timestamp_expires = now
+            max_age = timestamp_expires - now
+            headers.append(('Expires', datetime.utcfromtimestamp(timestamp_expires).strftime("%a, %d %b %Y %H:%M:%S GMT")))
+            headers.append(('Cache-Control', 'max-age=%d' % max_age))
+        if stream:
+            if client_not_modified:
+                stream.close()
+                start_response('304 Not Modified', headers)
+                return []
+            if stream.length:
+                headers.append(('Content-Length', stream.length))
+            start_response('200 OK', headers)
+            return stream
+        if client_not_modified:
+            start_response('304 Not Modified', headers)
+            return []
+        elif self.config['accel_redirect']:
+            accel_redirect = self.config['accel_redirect_path'] + image_dst[len(self.config['cache_dir']):]
+            if request_method == 'GET':
+                headers.append(('X-Accel-Redirect', accel_redirect))
+            start_response('200 OK', headers)
+            return []
+        else:
+            return self._serve_file(environ, start_response, image_dst, meta, headers, data)
 
     def app(self, environ, start_response):
         timer = Timer()
 
+        if environ['PATH_INFO'] == self.config['metrics_path']:
+            return self._serve_metrics(start_response)
+        labels = {'route': '', 'action': '', 'origin': ''}
+        start_response = self._measured(start_response, timer, labels)
+
         request_method = environ['REQUEST_METHOD']
         if request_method not in ('GET', 'HEAD'):
             start_response('405 Invalid Method', [])
@@ -190,64 +746,28 @@ class Server(object):
 
         self.logger.debug('client check modified etag=%s modified=%s', client_etag, client_modified_ts)
 
+        # origin responses can only be streamed when we serve the file ourselves
+        tee = self.config['proxy_tee'] and request_method == 'GET' and not self.config['accel_redirect']
+
         image_dst = None
-        for route in self.config['routing']:
-            for action in ('resize', 'proxy'):
-                ctx = route.get(action)
-                if not ctx:
-                    continue
-                regex = ctx.get('url_re')
-                if regex:
-                    match = re.match(regex, environ['PATH_INFO'])
-                    if match:
-                        self.logger.debug('matching %s for %s', regex, action)
-                        image_dst, meta = getattr(self, action)(ctx, match.groupdict())
-                        if image_dst:
-                            ext = image_dst.rsplit('.', 1)[-1]
-                            headers = [('Content-Type', 'image/%s' % ext), ('X-Response-Time', str(timer)), ]
-
-                            client_not_modified = False
-                            if meta.get('etag'):
-                                headers.append(('ETag', meta['etag']))
-                                if client_etag:
-                                    client_not_modified = client_etag == meta['etag']
-                            if meta.get('last_modified'):
-                                headers.append(('Last-Modified', meta['last_modified']))
-                                if not client_not_modified and client_modified_ts:
-                                    client_not_modified = date_to_ts(meta['last_modified']) <= client_modified_ts
-
-                            expires = meta.get('expires', 0)
-                            if isinstance(self.config['external_expires'], int):
-                                expires = max(self.config['external_expires'],  expires)
-                            if expires:
-                                now = time()
-                                timestamp_expires = meta.get('timestamp', now) + expires
-                                max_age = timestamp_expires - now
-                                headers.append(('Expires', datetime.utcfromtimestamp(timestamp_expires).strftime("%a, %d %b %Y %H:%M:%S GMT")))
-                                headers.append(('Cache-Control', 'max-age=%d' % max_age))
-                            if client_not_modified:
-                                start_response('304 Not Modified', headers)
-                                return []
-                            elif self.config['accel_redirect']:
-                                accel_redirect = self.config['accel_redirect_path'] + image_dst[len(self.config['cache_dir']):]
-                                if request_method == 'GET':
-                                    headers.append(('X-Accel-Redirect', accel_redirect))
-                                start_response('200 OK', headers)
-                                return []
-                            else:
-                                start_response('200 OK', headers)
-                                if request_method == 'HEAD':
-                                    return []
-                                try:
-                                    image = open(image_dst, 'rb')
-                                except IOError as exc:
-                                    self.logger.error('can\'t open %s: %s', image_dst, exc)
-                                    return []
-                                try:
-                                    return environ['wsgi.file_wrapper'](image, self.config['chunk_size'])
-                                except KeyError:
-                                    return iter(partial(image.read, self.config['chunk_size']), b'')
-                        break
+        for route, values in self.router.match(environ['PATH_INFO']):
+            self.logger.debug('matching %s for %s', route.url_re, route.action)
+            labels.update(route=str(route.route_index), action=route.action, origin=route.origin or '')
+            try:
+                image_dst, meta, stream = getattr(self, route.action)(route, values, tee, environ.get('HTTP_ACCEPT', ''))
+            except ResizeBusy as exc:
+                self.logger.warning('resize of %s rejected: %s', environ['PATH_INFO'], exc)
+                start_response('503 Service Unavailable', [('Retry-After', '1'), ('X-Response-Time', str(timer))])
+                return []
+            if image_dst:
+                try:
+                    return self._respond(environ, start_response, route, timer, image_dst, meta, stream,
+                                         client_etag, client_modified_ts)
+                except BaseException:
+                    if stream and not isinstance(stream, bytes):
+                        # the client won't read it
+                        stream.close()
+                    raise
 
         start_response('404 Not Found', [('X-Response-Time', str(timer))])
         return []
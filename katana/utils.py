@@ -1,13 +1,23 @@
 import os
 import errno
 import fcntl
+import logging
+from collections import OrderedDict
 from contextlib import contextmanager
 from time import time, sleep
 
+from gevent import getcurrent, spawn
+from gevent.event import AsyncResult
+from gevent.queue import Queue
+
+from . import metrics
+
 
 @contextmanager
 def wlock(filename, retry_interval=0.05):
     # returns: write, exists, fd
+    # the time waited for the lock is observed in katana_wlock_wait_seconds
+    start = time()
     try:
         with open(filename, 'rb+') as lock:
             try:
@@ -24,11 +34,13 @@ def wlock(filename, retry_interval=0.05):
                             else:
                                 raise
                         else:
+                            metrics.observe('katana_wlock_wait_seconds', time() - start, mode='read')
                             yield False, True, lock
                             break
                 else:
                     raise
             else:
+                metrics.observe('katana_wlock_wait_seconds', time() - start, mode='write')
                 yield True, True, lock
     except IOError as exc:
         if exc.errno == errno.ENOENT:
@@ -43,23 +55,217 @@ def wlock(filename, retry_interval=0.05):
                         else:
                             raise
                     else:
-                        yield True, False, lock
-
-                        if os.path.exists(filename):
-                            if not lock.closed:
-                                lock.seek(0, 2)
-                                if not lock.tell():
+                        metrics.observe('katana_wlock_wait_seconds', time() - start, mode='write')
+                        try:
+                            yield True, False, lock
+                        finally:
+                            # nothing was written, eg: the caller raised
+                            if os.path.exists(filename):
+                                if not lock.closed:
+                                    lock.seek(0, 2)
+                                    if not lock.tell():
+                                        os.unlink(filename)
+                                elif not os.path.getsize(filename):
                                     os.unlink(filename)
-                            elif not os.path.getsize(filename):
-                                os.unlink(filename)
                         break
         else:
             raise
 
 
+def negotiate_format(accept, formats):
+    """Returns the first of formats (eg: 'webp') explicitly accepted as image/<format>, or None.
+
+    Wildcards are ignored: browsers send */* even for formats they can't decode.
+    """
+    accepted = set()
+    for item in accept.split(','):
+        params = item.strip().split(';')
+        media_type = params[0].strip().lower()
+        if not media_type.startswith('image/'):
+            continue
+        try:
+            q = float(next((p.split('=', 1)[1] for p in params[1:] if p.strip().startswith('q=')), 1))
+        except ValueError:
+            q = 0
+        if q > 0:
+            accepted.add(media_type[6:])
+    for fmt in formats:
+        if fmt in accepted:
+            return fmt
+    return None
+
+
+def variant_etag(etag, fmt):
+    """Returns the ETag of the fmt representation of a file whose ETag is etag (eg: '"abc"' => '"abc-webp"')."""
+    weak = 'W/' if etag.startswith('W/') else ''
+    return '%s"%s-%s"' % (weak, etag[len(weak):].strip('"'), fmt)
+
+
 class Timer:
     def __init__(self):
         self.start = time()
 
     def __str__(self):
         return '%.3f ms' % ((time() - self.start) * 1000)
+
+
+class LRUCache(object):
+    """A bounded LRU mapping whose entries expire after ttl seconds.
+
+    Args:
+        max_size (int): maximum total size of the entries, 0 disables the cache.
+        ttl (int): number of seconds an entry is valid, 0 means forever.
+        sizeof: returns the size of a value, every entry counts for 1 by default.
+    """
+
+    def __init__(self, max_size, ttl=0, sizeof=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.items = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        try:
+            value, expires, size = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires and expires < time():
+            self.delete(key)
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Sets key to value for ttl seconds, the ttl of the cache by default."""
+        size = self.sizeof(value) if self.sizeof else 1
+        if size > self.max_size:
+            self.delete(key)
+            return
+        self.delete(key)
+        ttl = self.ttl if ttl is None else ttl
+        self.items[key] = (value, time() + ttl if ttl else 0, size)
+        self.size += size
+        while self.size > self.max_size:
+            self.size -= self.items.popitem(last=False)[1][2]
+
+    def delete(self, key):
+        item = self.items.pop(key, None)
+        if item:
+            self.size -= item[2]
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+    def stats(self):
+        return {'size': self.size, 'items': len(self.items), 'hits': self.hits, 'misses': self.misses}
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls for the same key in the process.
+
+    The first greenlet calling do() for a key runs the function, the others
+    block until its result is ready and get the same result (or exception).
+    """
+
+    def __init__(self):
+        self.calls = {}
+
+    def do(self, key, func, *args):
+        call = self.calls.get(key)
+        if call is not None:
+            return call.get()
+
+        call = self.calls[key] = AsyncResult()
+        try:
+            result = func(*args)
+        except BaseException as exc:
+            call.set_exception(exc)
+            raise
+        else:
+            call.set(result)
+            return result
+        finally:
+            del self.calls[key]
+
+
+class TeeStream(object):
+    """A WSGI iterable sending a response while writing it to a file.
+
+    A greenlet downloads the response to the file at the speed of the origin and
+    queues the chunks for the client, so the origin connection and the lock on the
+    file (an ExitStack) are released as soon as the file is written, whatever the
+    speed of the client. If the client goes away early, close() stops queueing the
+    chunks and the download goes on. If reading the response fails, the file is
+    truncated so that wlock removes it, and the client gets a truncated response.
+
+    Args:
+        resp: the response to read from.
+        fd: the file to write to.
+        lock (ExitStack): released once the file is written.
+        chunk_size (int): the size of the chunks read from the response.
+        callback: called with True if the file was fully written, False otherwise.
+    """
+
+    def __init__(self, resp, fd, lock, chunk_size, callback):
+        self.resp = resp
+        self.fd = fd
+        self.lock = lock
+        self.chunk_size = chunk_size
+        self.callback = callback
+        self.length = resp.headers.get('content-length')
+        self.owner = getcurrent()
+        self.done = AsyncResult()
+        self.closed = False
+        # the chunks not sent to the client yet, None once the download is over
+        self.chunks = Queue()
+        self.logger = logging.getLogger('katana.utils')
+        self.pump = spawn(self._pump)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = None if self.closed else self.chunks.get()
+        if chunk is None:
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        self.closed = True
+        self.chunks = Queue()
+
+    def _pump(self):
+        try:
+            while True:
+                chunk = self.resp.read(self.chunk_size)
+                if not chunk:
+                    break
+                self.fd.write(chunk)
+                if not self.closed:
+                    self.chunks.put(chunk)
+        except Exception:
+            self.logger.exception('streaming to %s failed', self.fd.name)
+            self._finish(False)
+        else:
+            self._finish(True)
+
+    def _finish(self, complete):
+        try:
+            if not complete:
+                self.fd.truncate(0)
+            self.resp.close()
+            self.lock.close()
+        finally:
+            self.chunks.put(None)
+            self.callback(complete)
+            self.done.set(complete)
@@ -0,0 +1,152 @@
+__all__ = ['FileWrapper', 'SendfileHandler', 'parse_range']
+
+import os
+import errno
+import uuid
+
+from gevent.pywsgi import WSGIHandler
+from gevent.socket import wait_write
+
+# above that many ranges the whole file is served
+MAX_RANGES = 16
+
+
+def parse_range(header, size):
+    """Parses a Range header against a file of size bytes.
+
+    Returns:
+        A sorted list of (start, end) inclusive byte ranges, overlapping ranges being
+        merged, [] if no range is satisfiable and None if the header must be ignored.
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip().lower() != 'bytes':
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        start, sep, end = spec.strip().partition('-')
+        try:
+            if not sep:
+                return None
+            if not start:
+                # suffix range: the last end bytes
+                length = int(end)
+                if length > 0:
+                    ranges.append((max(0, size - length), size - 1))
+                continue
+            start = int(start)
+            end = int(end) if end else None
+        except ValueError:
+            return None
+        if end is None:
+            end = size - 1
+        elif start > end:
+            return None
+        if start < size:
+            ranges.append((start, min(end, size - 1)))
+    if len(ranges) > MAX_RANGES:
+        return None
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+class FileWrapper(object):
+    """A wsgi.file_wrapper serving byte ranges of a file.
+
+    The body is a list of parts: (prefix, offset, length) where prefix is sent before
+    length bytes of the file at offset, and trailer is sent after the last part. It is
+    iterable for any WSGI server, SendfileHandler sends the file parts with sendfile.
+
+    Args:
+        filelike: the opened file.
+        block_size (int): size of the chunks read when iterating.
+        parts (list): the parts of the body, the whole file by default.
+        trailer (bytes): sent after the parts.
+    """
+
+    def __init__(self, filelike, block_size=16 * 1024, parts=None, trailer=b''):
+        self.filelike = filelike
+        self.block_size = block_size
+        if parts is None:
+            parts = [(b'', 0, os.fstat(filelike.fileno()).st_size)]
+        self.parts = parts
+        self.trailer = trailer
+
+    @classmethod
+    def ranges(cls, filelike, block_size, ranges, size, content_type):
+        """Returns the wrapper of a multipart/byteranges body and its Content-Type."""
+        boundary = uuid.uuid4().hex
+        parts = []
+        for start, end in ranges:
+            prefix = '--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                boundary, content_type, start, end, size)
+            parts.append(((('\r\n' if parts else '') + prefix).encode('latin-1'), start, end - start + 1))
+        trailer = ('\r\n--%s--\r\n' % boundary).encode('latin-1')
+        return cls(filelike, block_size, parts, trailer), 'multipart/byteranges; boundary=%s' % boundary
+
+    @property
+    def length(self):
+        return sum(len(prefix) + length for prefix, _, length in self.parts) + len(self.trailer)
+
+    def __iter__(self):
+        for prefix, offset, length in self.parts:
+            if prefix:
+                yield prefix
+            self.filelike.seek(offset)
+            while length > 0:
+                data = self.filelike.read(min(self.block_size, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+        if self.trailer:
+            yield self.trailer
+
+    def close(self):
+        self.filelike.close()
+
+
+def sendfile(sock, fd, offset, length):
+    """Sends length bytes of fd at offset to the gevent socket sock without copying them in userspace."""
+    sent = 0
+    while sent < length:
+        try:
+            count = os.sendfile(sock.fileno(), fd, offset + sent, length - sent)
+        except OSError as exc:
+            if exc.errno != errno.EAGAIN:
+                raise
+            wait_write(sock.fileno(), timeout=sock.gettimeout())
+            continue
+        if not count:
+            break
+        sent += count
+    return sent
+
+
+class SendfileHandler(WSGIHandler):
+    """A gevent WSGIHandler providing FileWrapper as wsgi.file_wrapper and sending its file
+    parts with os.sendfile.
+    """
+
+    def get_environ(self):
+        environ = super(SendfileHandler, self).get_environ()
+        environ['wsgi.file_wrapper'] = FileWrapper
+        return environ
+
+    def process_result(self):
+        if not isinstance(self.result, FileWrapper) or self.code in (304, 204):
+            return super(SendfileHandler, self).process_result()
+        # the application sets the Content-Length of a FileWrapper, the body is not chunked
+        self.write(b'')
+        if self.command == 'HEAD':
+            return
+        fd = self.result.filelike.fileno()
+        for prefix, offset, length in self.result.parts:
+            if prefix:
+                self._write(prefix)
+            self.response_length += sendfile(self.socket, fd, offset, length)
+        self._write(self.result.trailer)